@@ -1,5 +1,6 @@
+from functools import cached_property
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 import os
 from flask import Flask, request, current_app
 from flask_sqlalchemy import SQLAlchemy
@@ -8,10 +9,8 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
 from config import Config
+from app.log import JSONFormatter, RateLimitedSMTPHandler, init_logging
 
 
 def get_locale():
@@ -28,8 +27,42 @@ moment = Moment()
 babel = Babel()
 
 
+class Genblog(Flask):
+    """
+    Flask application with service clients that are created on first use,
+    so that starting the application does not import or connect to the
+    services it does not need. Assigning a client replaces it.
+    """
+    #: The configuration class that the application was created with, which
+    #: worker processes use to create their own copy of the application.
+    config_object = Config
+
+    @cached_property
+    def elasticsearch(self):
+        if not self.config['ELASTICSEARCH_URL']:
+            return None
+        from elasticsearch import Elasticsearch
+        return Elasticsearch([self.config['ELASTICSEARCH_URL']])
+
+    @cached_property
+    def redis(self):
+        from redis import Redis
+        return Redis.from_url(self.config['REDIS_URL'])
+
+    @cached_property
+    def task_queue(self):
+        import rq
+        return rq.Queue('genblog-tasks', connection=self.redis)
+
+    @cached_property
+    def mail_queue(self):
+        import rq
+        return rq.Queue('genblog-mail', connection=self.redis)
+
+
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = Genblog(__name__)
+    app.config_object = config_class
     app.config.from_object(config_class)
 
     db.init_app(app)
@@ -38,10 +71,6 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('genblog-tasks', connection=app.redis)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -59,6 +88,7 @@ def create_app(config_class=Config):
     app.register_blueprint(api_bp, url_prefix='/api')
 
     if not app.debug and not app.testing:
+        handlers = []
         if app.config['MAIL_SERVER']:
             auth = None
             if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
@@ -67,33 +97,68 @@ def create_app(config_class=Config):
             secure = None
             if app.config['MAIL_USE_TLS']:
                 secure = ()
-            mail_handler = SMTPHandler(
+            mail_handler = RateLimitedSMTPHandler(
                 mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
                 fromaddr='no-reply@' + app.config['MAIL_SERVER'],
                 toaddrs=app.config['ADMINS'], subject='Genblog Failure',
-                credentials=auth, secure=secure)
+                credentials=auth, secure=secure, timeout=10,
+                interval=app.config['LOG_MAIL_INTERVAL'],
+                max_per_interval=app.config['LOG_MAIL_MAX_PER_INTERVAL'])
+            mail_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '
+                '[in %(pathname)s:%(lineno)d, request %(request_id)s]',
+                defaults={'request_id': None}))
             mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+            handlers.append(mail_handler)
 
         if app.config['LOG_TO_STDOUT']:
             stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(JSONFormatter())
             stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
+            handlers.append(stream_handler)
         else:
             if not os.path.exists('logs'):
                 os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/genblog.log',
-                                               maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]'))
+            file_handler = RotatingFileHandler(
+                'logs/genblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+                backupCount=10)
+            file_handler.setFormatter(JSONFormatter())
             file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
+            handlers.append(file_handler)
 
-        app.logger.setLevel(logging.INFO)
+        init_logging(app, handlers)
         app.logger.info('Genblog startup')
 
     return app
 
 
+def preload(app):
+    """
+    Do the work that every process of the application would otherwise repeat
+    on its first requests or jobs: import the service client libraries,
+    load the language profiles and compile the templates. Call this in a
+    parent process that forks the workers, such as gunicorn with
+    --preload, so that the workers share the result. Connections are not
+    opened here, since they cannot be shared with forked processes.
+
+    Args:
+        app (Flask): The application.
+    """
+    import elasticsearch  # noqa: F401
+    import rq  # noqa: F401
+    from app import language
+    from app.search import elastic  # noqa: F401
+    language.warm_up()
+    for name in app.jinja_env.list_templates(extensions=['html', 'txt']):
+        app.jinja_env.get_template(name)
+
+    def dispose_engines():
+        # forked processes must not use the connections of their parent
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose_engines)
+
+
 from app import models
\ No newline at end of file
@@ -1,12 +1,26 @@
 from flask import request, url_for, abort
 import sqlalchemy as sa
 
-from app import db
+from app import db, versions
 from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
 
+
+def requested_fields():
+    """
+    Return the fields selected with the fields query string argument.
+
+    Returns:
+        list: The names of the fields, or None to include all of them.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
@@ -19,26 +33,34 @@ def get_user(id):
     Returns:
         dict: The user's data as a dictionary.
     """
-    return db.get_or_404(User, id).to_dict()
+    user = db.get_or_404(User, id)
+    fields = requested_fields()
+    etag = versions.page_etag([versions.user_key(id)], user.last_seen, fields,
+                              html=False)
+    if versions.is_fresh(etag):
+        return versions.not_modified(etag)
+    return versions.tagged(user.to_dict(fields=fields), etag)
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
     """
-    Retrieve a paginated list of users.
+    Retrieve a cursor paginated list of users.
 
     Returns:
         dict: A dictionary containing the users' data.
     """
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users')
+    return User.to_collection_dict(
+        sa.select(User), cursor, per_page, 'api.get_users',
+        fields=requested_fields())
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     """
-    Retrieve a paginated list of followers for a user.
+    Retrieve a cursor paginated list of followers for a user.
 
     Args:
         id (int): The ID of the user.
@@ -47,15 +69,17 @@ def get_followers(id):
         dict: A dictionary containing the followers' data.
     """
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', id=id)
+    return User.to_collection_dict(
+        user.followers.select(), cursor, per_page, 'api.get_followers',
+        fields=requested_fields(), id=id)
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
 def get_following(id):
     """
-    Retrieve a paginated list of users followed by a user.
+    Retrieve a cursor paginated list of users followed by a user.
 
     Args:
         id (int): The ID of the user.
@@ -64,9 +88,11 @@ def get_following(id):
         dict: A dictionary containing the followed users' data.
     """
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following', id=id)
+    return User.to_collection_dict(
+        user.following.select(), cursor, per_page, 'api.get_following',
+        fields=requested_fields(), id=id)
 
 @bp.route('/users', methods=['POST'])
 def create_user():
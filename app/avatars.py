@@ -0,0 +1,134 @@
+from functools import lru_cache
+from hashlib import md5
+import os
+import re
+from flask import current_app, url_for
+
+# The sizes the pages show avatars in, which are the only ones proxied
+SIZES = (60, 64, 128, 200)
+DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def email_digest(email):
+    """
+    Return the Gravatar digest of an email address.
+
+    Args:
+        email (str): The email address.
+
+    Returns:
+        str: The hexadecimal MD5 digest of the normalized address.
+    """
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def gravatar_url(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
+def avatar_url(digest, size):
+    """
+    Return the URL of an avatar. The URL points to the local avatar proxy
+    when AVATAR_PROXY is set and the size is one that it serves, and to
+    Gravatar otherwise.
+
+    Args:
+        digest (str): The Gravatar digest of the user's email address.
+        size (int): The size of the avatar in pixels.
+
+    Returns:
+        str: The URL of the avatar.
+    """
+    if current_app.config['AVATAR_PROXY'] and size in SIZES:
+        return url_for('main.avatar', digest=digest, size=size)
+    return gravatar_url(digest, size)
+
+
+def valid_request(digest, size):
+    return DIGEST_RE.match(digest) is not None and size in SIZES
+
+
+def cache_path(directory, digest, size):
+    return os.path.join(directory, digest[:2], f'{digest}-{size}')
+
+
+def fetch_avatar(digest, size):
+    """
+    Return the cached copy of an avatar, downloading it from Gravatar if it
+    is not cached yet. The download is written under a temporary name and
+    moved into place, so concurrent requests never see a partial file.
+    Cached copies are touched when they are used, and the least recently
+    used ones are deleted when the cache grows past AVATAR_CACHE_MAX_BYTES.
+
+    Args:
+        digest (str): The Gravatar digest of the user's email address.
+        size (int): The size of the avatar in pixels.
+
+    Returns:
+        tuple: The path of the cached file and its content type, or None if
+            the avatar could not be downloaded.
+    """
+    directory = current_app.config['AVATAR_CACHE_DIR']
+    path = cache_path(directory, digest, size)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        import requests
+        try:
+            r = requests.get(gravatar_url(digest, size),
+                             timeout=current_app.config['AVATAR_TIMEOUT'])
+        except requests.exceptions.RequestException as e:
+            current_app.logger.warning(f'Avatar download error: {e}')
+            return None
+        if r.status_code != 200:
+            current_app.logger.warning(
+                f'Avatar download error: status {r.status_code}')
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{os.getpid()}.tmp'
+        with open(partial, 'wb') as f:
+            f.write(r.content)
+        with open(f'{partial}.type', 'w') as f:
+            f.write(r.headers.get('Content-Type', 'image/png'))
+        os.replace(f'{partial}.type', f'{path}.type')
+        os.replace(partial, path)
+        prune_cache(directory, current_app.config['AVATAR_CACHE_MAX_BYTES'])
+    try:
+        with open(f'{path}.type') as f:
+            mimetype = f.read()
+    except OSError:
+        mimetype = 'image/png'
+    return path, mimetype
+
+
+def prune_cache(directory, max_bytes):
+    """
+    Delete the least recently used avatars from the cache until it holds at
+    most the given number of bytes.
+
+    Args:
+        directory (str): The cache directory.
+        max_bytes (int): The maximum size of the cached avatars.
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(('.type', '.tmp')):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        for name in (path, f'{path}.type'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+        total -= size
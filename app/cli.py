@@ -1,6 +1,15 @@
+from datetime import datetime
 import os
-from flask import Blueprint
+import time
+from flask import Blueprint, current_app
 import click
+import sqlalchemy as sa
+
+from app import db, email, language
+from app.models import User, Post, Comment, Message, IndexOutbox, \
+    SearchableMixin, followers, post_likes
+from app.search import ensure_index, get_backend, rebuild_index
+from app.search.backend import UnmanagedIndexError
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -38,3 +47,263 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+def reconcile_counters(model, counts, batch_size):
+    """
+    Recompute the counter columns of a model in primary key batches and
+    write back the ones that drifted.
+
+    Args:
+        model (Model): The model that owns the counters.
+        counts (dict): Maps each counter column name to the foreign key
+            column whose rows it counts.
+        batch_size (int): The number of rows checked per batch.
+
+    Returns:
+        int: The number of rows that were fixed.
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            sa.select(model.id, *[getattr(model, name) for name in counts])
+            .where(model.id > last_id).order_by(model.id)
+            .limit(batch_size)).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+        actual = {name: dict(db.session.execute(
+            sa.select(key, sa.func.count()).where(key.in_(ids))
+            .group_by(key)).all()) for name, key in counts.items()}
+        updates = []
+        for row in rows:
+            values = {name: actual[name].get(row.id, 0) for name in counts}
+            if any(getattr(row, name) != value
+                   for name, value in values.items()):
+                updates.append({'id': row.id, **values})
+        if updates:
+            db.session.execute(sa.update(model), updates)
+            db.session.commit()
+        fixed += len(updates)
+        last_id = ids[-1]
+    return fixed
+
+
+def reconcile_unread_messages(batch_size):
+    """
+    Recount the unread messages of users in primary key batches and write
+    back the counts that drifted. The counts use the message index on
+    (recipient_id, timestamp).
+
+    Args:
+        batch_size (int): The number of users checked per batch.
+
+    Returns:
+        int: The number of users that were fixed.
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            sa.select(User.id, User.num_unread_messages)
+            .where(User.id > last_id).order_by(User.id)
+            .limit(batch_size)).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+        actual = dict(db.session.execute(
+            sa.select(Message.recipient_id, sa.func.count())
+            .join(User, User.id == Message.recipient_id)
+            .where(Message.recipient_id.in_(ids),
+                   Message.timestamp > sa.func.coalesce(
+                       User.last_message_read_time, datetime(1900, 1, 1)))
+            .group_by(Message.recipient_id)).all())
+        updates = [{'id': row.id, 'num_unread_messages': actual.get(row.id, 0)}
+                   for row in rows
+                   if row.num_unread_messages != actual.get(row.id, 0)]
+        if updates:
+            db.session.execute(sa.update(User), updates)
+            db.session.commit()
+        fixed += len(updates)
+        last_id = ids[-1]
+    return fixed
+
+
+@counters.command()
+@click.option('--batch-size', default=1000,
+              help='Number of rows checked per batch.')
+def reconcile(batch_size):
+    """Recompute the counters and fix any drift."""
+    fixed = reconcile_counters(User, {
+        'num_followers': followers.c.followed_id,
+        'num_following': followers.c.follower_id}, batch_size)
+    click.echo(f'Fixed {fixed} user counters.')
+    fixed = reconcile_counters(Post, {
+        'num_likes': post_likes.c.post_id,
+        'num_comments': Comment.post_id}, batch_size)
+    click.echo(f'Fixed {fixed} post counters.')
+    fixed = reconcile_unread_messages(batch_size)
+    click.echo(f'Fixed {fixed} unread message counters.')
+
+
+@bp.cli.group('language')
+def language_group():
+    """Post language detection commands."""
+    pass
+
+
+def backfill_languages(batch_size, progress=None):
+    """
+    Detect the language of the posts that do not have one, in batches
+    ordered by ID, committing each batch. Posts that have no detectable
+    language get an empty string, so that they are not checked again.
+
+    Args:
+        batch_size (int): The number of posts per batch.
+        progress (callable): Called with the number of posts checked and
+            detected so far after each batch.
+
+    Returns:
+        tuple: The number of posts checked and detected.
+    """
+    language.warm_up()
+    last_id = 0
+    checked = detected = 0
+    while True:
+        posts = db.session.scalars(
+            sa.select(Post)
+            .where(Post.language.is_(None), Post.id > last_id)
+            .order_by(Post.id)
+            .limit(batch_size)).all()
+        if not posts:
+            break
+        detected += language.detect_post_languages(posts)
+        checked += len(posts)
+        last_id = posts[-1].id
+        # the search index picks up the new languages on commit
+        db.session.commit()
+        db.session.expunge_all()
+        if progress:
+            progress(checked, detected)
+    return checked, detected
+
+
+@language_group.command()
+@click.option('--batch-size', default=500,
+              help='Number of posts checked per batch.')
+def backfill(batch_size):
+    """Detect the language of the posts that do not have one."""
+    def progress(checked, detected):
+        click.echo(f'\r{checked} checked, {detected} detected', nl=False)
+
+    checked, detected = backfill_languages(batch_size, progress=progress)
+    click.echo(f'\nDetected the language of {detected} of {checked} posts.')
+
+
+@bp.cli.group('mail')
+def mail_group():
+    """Email delivery commands."""
+    pass
+
+
+@mail_group.command()
+@click.option('--count', default=100, help='Number of messages to send.')
+@click.option('--recipient', default='test@example.com',
+              help='Recipient of the messages.')
+def benchmark(count, recipient):
+    """Measure the email delivery rate.
+
+    Point MAIL_SERVER and MAIL_PORT at a local sink first, for example
+    the aiosmtpd server in the requirements:
+
+        aiosmtpd -n -c aiosmtpd.handlers.Sink -l localhost:8025
+    """
+    rate = email.benchmark(count, recipient,
+                           current_app.config['ADMINS'][0])
+    click.echo(f'Sent {count} messages, {rate:.0f} messages/sec.')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.option('--batch-size', default=500,
+              help='Number of changes applied per batch.')
+@click.option('--follow', is_flag=True,
+              help='Keep applying new changes as they arrive.')
+@click.option('--interval', default=1.0,
+              help='Seconds to wait when there are no changes to apply.')
+def drain(batch_size, follow, interval):
+    """Apply the pending changes in the search index outbox."""
+    while True:
+        applied = IndexOutbox.drain(batch_size)
+        if applied:
+            click.echo(f'Applied {applied} index changes.')
+        if not follow:
+            break
+        if not applied:
+            time.sleep(interval)
+
+
+@search.command()
+def init():
+    """Create the search indexes that do not exist yet."""
+    if get_backend() is None:
+        raise click.ClickException('Search is not configured.')
+    for alias, model in SearchableMixin.searchable_models().items():
+        try:
+            click.echo(f'{alias} -> {ensure_index(model)}')
+        except UnmanagedIndexError as e:
+            raise click.ClickException(str(e))
+
+
+@search.command()
+@click.option('--chunk-size', default=1000,
+              help='Number of records indexed per bulk request.')
+@click.option('--workers', default=1, help='Number of worker processes.')
+@click.option('--keep-old', is_flag=True,
+              help='Keep the indexes that were replaced.')
+def rebuild(chunk_size, workers, keep_old):
+    """Rebuild the search indexes without taking search offline."""
+    if get_backend() is None:
+        raise click.ClickException('Search is not configured.')
+    for alias, model in SearchableMixin.searchable_models().items():
+        def progress(indexed, failed, elapsed):
+            rate = indexed / elapsed if elapsed else 0
+            click.echo(f'\r{alias}: {indexed} indexed, {failed} failed, '
+                       f'{rate:.0f} docs/sec', nl=False)
+
+        index = rebuild_index(model, chunk_size=chunk_size, workers=workers,
+                              keep_old=keep_old, progress=progress)
+        click.echo(f'\n{alias} -> {index}')
+
+
+@search.command()
+@click.option('--chunk-size', default=1000,
+              help='Number of records indexed per bulk request.')
+@click.option('--workers', default=1, help='Number of worker processes.')
+@click.option('--restart', is_flag=True,
+              help='Ignore the saved checkpoint and start over.')
+def reindex(chunk_size, workers, restart):
+    """Rebuild the search index of every searchable model."""
+    if get_backend() is None:
+        raise click.ClickException('Search is not configured.')
+    for index, model in SearchableMixin.searchable_models().items():
+        def progress(indexed, failed, elapsed):
+            rate = indexed / elapsed if elapsed else 0
+            click.echo(f'\r{index}: {indexed} indexed, {failed} failed, '
+                       f'{rate:.0f} docs/sec', nl=False)
+
+        model.reindex(chunk_size=chunk_size, workers=workers,
+                      resume=not restart, progress=progress)
+        click.echo()
@@ -1,24 +1,203 @@
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import smtplib
+from threading import Lock
+import time
+import redis
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
+# The SMTP connection of the process, kept open across messages. Only the
+# mail worker, which runs its jobs in one process, reuses it across jobs.
+_connection = None
+_connection_lock = Lock()
+# Delivers mail when the queue is not available
+_pool = None
+_pool_lock = Lock()
 
-def send_async_email(app, msg):
+
+class TransientMailError(Exception):
+    pass
+
+
+def build_message(data):
+    """
+    Build a message from the fields given to send_email.
+
+    Args:
+        data (dict): The subject, sender, recipients, text and html bodies,
+            and attachments of the message.
+
+    Returns:
+        Message: The message.
+    """
+    msg = Message(data['subject'], sender=data['sender'],
+                  recipients=data['recipients'])
+    msg.body = data['text_body']
+    msg.html = data['html_body']
+    for attachment in data.get('attachments') or []:
+        msg.attach(*attachment)
+    return msg
+
+
+def is_transient(error):
+    """
+    Return True if sending may succeed on a new connection or later.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # SMTP errors are OSErrors too, the others are network errors
+    return isinstance(error, OSError) and \
+        not isinstance(error, smtplib.SMTPException)
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+        _connection = None
+
+
+def deliver(data):
+    """
+    Send a message over the SMTP connection of the process, opening it if
+    needed. A transient failure is retried once on a new connection, since
+    servers drop connections that are idle for too long.
+
+    Args:
+        data (dict): The fields of the message, as given to send_email.
+
+    Returns:
+        bool: True if the message was sent, False if the server refused it
+            for good.
+
+    Raises:
+        TransientMailError: If the message could not be sent, but might be
+            later.
+    """
+    global _connection
+    msg = build_message(data)
+    with _connection_lock:
+        for attempt in range(2):
+            try:
+                if _connection is None:
+                    _connection = mail.connect().__enter__()
+                _connection.send(msg)
+                return True
+            except Exception as e:
+                close_connection()
+                if not is_transient(e):
+                    current_app.logger.error(
+                        f'Email to {data["recipients"]} failed: {e}')
+                    return False
+                if attempt:
+                    raise TransientMailError(str(e)) from e
+
+
+def deliver_batch(messages, sent=0, progress=None):
+    """
+    Send messages in order over one connection.
+
+    Args:
+        messages (list): The fields of each message.
+        sent (int): The number of messages that were already sent by a
+            previous attempt, which are skipped.
+        progress (callable): Called with the number of messages handled
+            after each message.
+
+    Returns:
+        int: The number of messages that were sent.
+
+    Raises:
+        TransientMailError: If a message could not be sent, but might be
+            later. The messages before it were handled.
+    """
+    delivered = 0
+    for i in range(sent, len(messages)):
+        if deliver(messages[i]):
+            delivered += 1
+        if progress:
+            progress(i + 1)
+    return delivered
+
+
+def _deliver_in_context(app, messages):
     with app.app_context():
-        mail.send(msg)
+        try:
+            deliver_batch(messages)
+        except TransientMailError as e:
+            app.logger.error(f'Email failed: {e}')
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=current_app.config['MAIL_POOL_SIZE'],
+                thread_name_prefix='mail')
+        return _pool
+
+
+def send_emails(messages, sync=False):
+    """
+    Send a batch of messages. The batch is queued for the mail worker,
+    which runs its jobs without forking and so delivers every batch over
+    the same SMTP connection, and retried with backoff when the server is
+    unavailable. If the queue is not available, the batch is delivered
+    by a bounded pool of threads of this process instead.
+
+    Args:
+        messages (list): The fields of each message, as given to
+            send_email.
+        sync (bool): Whether to send the messages before returning.
+    """
+    if sync:
+        deliver_batch(messages)
+        return
+    from rq import Retry
+    intervals = current_app.config['MAIL_RETRY_INTERVALS']
+    try:
+        current_app.mail_queue.enqueue(
+            'app.tasks.send_emails', messages,
+            retry=Retry(max=len(intervals), interval=intervals))
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Email queue error: {e}')
+        _get_pool().submit(_deliver_in_context,
+                           current_app._get_current_object(), messages)
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
                attachments=None, sync=False):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    if attachments:
-        for attachment in attachments:
-            msg.attach(*attachment)
-    if sync:
-        mail.send(msg)
-    else:
-        Thread(target=send_async_email,
-               args=(current_app._get_current_object(), msg)).start()
+    send_emails([{
+        'subject': subject,
+        'sender': sender,
+        'recipients': recipients,
+        'text_body': text_body,
+        'html_body': html_body,
+        'attachments': attachments
+    }], sync=sync)
+
+
+def benchmark(count, recipient, sender):
+    """
+    Send test messages as fast as possible over one connection.
+
+    Args:
+        count (int): The number of messages.
+        recipient (str): The recipient of the messages.
+        sender (str): The sender of the messages.
+
+    Returns:
+        float: The number of messages sent per second.
+    """
+    start = time.monotonic()
+    deliver_batch([{'subject': f'Test message {i}', 'sender': sender,
+                    'recipients': [recipient], 'text_body': 'Test',
+                    'html_body': '<p>Test</p>'} for i in range(count)])
+    return count / (time.monotonic() - start)
@@ -0,0 +1,86 @@
+import gzip
+import json
+import os
+from time import monotonic
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post
+
+
+def export_path(directory, user):
+    """
+    Return the path of the posts export of a user. Each user has a single
+    export file, which is replaced by the next export.
+
+    Args:
+        directory (str): The directory where exports are stored.
+        user (User): The user.
+
+    Returns:
+        str: The path of the export file.
+    """
+    return os.path.join(directory, f'posts-{user.id}.ndjson.gz')
+
+
+def export_posts(user, path, batch_size=1000, progress=None,
+                 progress_interval=1.0):
+    """
+    Write the posts of a user, oldest first, to a gzip compressed file with
+    one JSON object per line. Posts are read in batches by key and written
+    as they arrive, so memory use does not depend on the number of posts.
+    Each batch is read in full before progress is reported, since a read
+    that stays open blocks the commit of the progress on SQLite. The file
+    is written under a temporary name and moved into place when it is
+    complete.
+
+    Args:
+        user (User): The user whose posts are exported.
+        path (str): The path of the export file.
+        batch_size (int): The number of posts read per batch.
+        progress (callable): Called with the percentage of posts written, at
+            most once per progress_interval seconds.
+        progress_interval (float): The minimum number of seconds between
+            progress reports.
+
+    Returns:
+        int: The number of posts exported.
+    """
+    total = user.posts_count()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.tmp'
+    count = 0
+    reported = monotonic()
+    query = sa.select(Post.id, Post.body, Post.timestamp).where(
+        Post.user_id == user.id).order_by(
+            Post.timestamp.asc(), Post.id.asc()).limit(batch_size)
+    try:
+        with gzip.open(partial, 'wt', encoding='utf-8') as f:
+            rows = []
+            while True:
+                batch = query
+                if rows:
+                    last = rows[-1]
+                    batch = query.where(sa.or_(
+                        Post.timestamp > last.timestamp,
+                        sa.and_(Post.timestamp == last.timestamp,
+                                Post.id > last.id)))
+                with db.engine.connect() as connection:
+                    rows = connection.execute(batch).all()
+                for row in rows:
+                    f.write(json.dumps({
+                        'body': row.body,
+                        'timestamp': row.timestamp.isoformat() + 'Z'
+                    }) + '\n')
+                count += len(rows)
+                if len(rows) < batch_size:
+                    break
+                if progress and monotonic() - reported >= progress_interval:
+                    # 100 is left for the end, even if posts were added
+                    progress(min(100 * count // max(total, 1), 99))
+                    reported = monotonic()
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return count
@@ -0,0 +1,72 @@
+import redis
+from flask import current_app
+
+from app import db
+
+
+def warm_up():
+    """
+    Load the language profiles of the detector, which langdetect otherwise
+    does on the first detection. Loading them before the worker processes
+    are forked lets them share the profiles.
+    """
+    # imported here, loading langdetect is slow
+    from langdetect import DetectorFactory
+    from langdetect.detector_factory import init_factory
+    # langdetect is randomized, a fixed seed gives the same language for the
+    # same text every time
+    DetectorFactory.seed = 0
+    init_factory()
+
+
+def detect_language(text):
+    """
+    Detect the language of a text.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: The language code, or an empty string if it is unknown.
+    """
+    warm_up()
+    from langdetect import LangDetectException, detect
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def detect_post_languages(posts):
+    """
+    Detect and set the language of each of the given posts.
+
+    Args:
+        posts (list): The posts.
+
+    Returns:
+        int: The number of posts whose language was detected.
+    """
+    detected = 0
+    for post in posts:
+        post.language = detect_language(post.body)
+        if post.language:
+            detected += 1
+    return detected
+
+
+def schedule_detection(post):
+    """
+    Queue the detection of the language of a new post. If the queue is not
+    available, the language is detected right away.
+
+    Args:
+        post (Post): The new post.
+    """
+    try:
+        current_app.task_queue.enqueue('app.tasks.detect_post_languages',
+                                       [post.id])
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Language detection queue error: {e}')
+        post.language = detect_language(post.body)
+        db.session.commit()
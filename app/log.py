@@ -0,0 +1,181 @@
+import atexit
+import copy
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+import os
+import queue
+from threading import Lock
+from time import monotonic
+import uuid
+from flask import current_app, g, has_request_context, request
+from flask.logging import default_handler
+
+# Record attributes copied into the JSON lines, when they are set
+EXTRA_FIELDS = ('request_id', 'method', 'path', 'status', 'latency_ms',
+                'remote_addr')
+
+
+class RequestQueueHandler(QueueHandler):
+    """
+    Queue handler that adds the details of the current request to records.
+    Records stay in the process, so unlike the base class it keeps their
+    exception information for the handlers on the other side of the queue.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+            record.remote_addr = request.remote_addr
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as single line JSON objects.
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created,
+                                           timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'location': f'{record.pathname}:{record.lineno}'
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class RateLimitedSMTPHandler(SMTPHandler):
+    """
+    SMTP handler that sends at most one mail per error location within an
+    interval, and at most a given number of mails per interval overall.
+    Errors that are held back are counted in the next mail that is sent
+    for their location.
+    """
+    def __init__(self, *args, interval=300, max_per_interval=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.max_per_interval = max_per_interval
+        self.sent = {}
+        self.suppressed = {}
+        self.window = (monotonic(), 0)
+        self.limit_lock = Lock()
+
+    def key(self, record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info else None
+        return record.pathname, record.lineno, exc_type
+
+    def allow(self, record):
+        now = monotonic()
+        key = self.key(record)
+        with self.limit_lock:
+            start, count = self.window
+            if now - start >= self.interval:
+                start, count = now, 0
+                self.sent = {k: t for k, t in self.sent.items()
+                             if now - t < self.interval}
+            if now - self.sent.get(key, -self.interval) < self.interval or \
+                    count >= self.max_per_interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                self.window = (start, count)
+                return False
+            self.sent[key] = now
+            self.window = (start, count + 1)
+            return True
+
+    def emit(self, record):
+        if not self.allow(record):
+            return
+        with self.limit_lock:
+            suppressed = self.suppressed.pop(self.key(record), 0)
+        if suppressed:
+            record = copy.copy(record)
+            record.msg = f'{record.msg}\n\n{suppressed} more errors from ' \
+                'here were not mailed.'
+        super().emit(record)
+
+
+def _log_request(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    if not current_app.config['LOG_REQUESTS']:
+        return response
+    latency = (monotonic() - g.request_start) * 1000 \
+        if 'request_start' in g else None
+    logging.getLogger('genblog.access').info(
+        '%s %s %s', request.method, request.path, response.status_code,
+        extra={'status': response.status_code,
+               'latency_ms': round(latency, 2) if latency else None})
+    return response
+
+
+def _start_request():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_start = monotonic()
+
+
+def init_logging(app, handlers):
+    """
+    Route the application logs through a queue, so that the given handlers
+    write files and send mail on a background thread instead of the thread
+    that logs. Requests get an ID, which is added to their log records and
+    to the X-Request-ID response header, and each request is logged with
+    its status and latency.
+
+    Args:
+        app (Flask): The application.
+        handlers (list): The handlers that the queued records are sent to.
+    """
+    records = queue.SimpleQueue()
+
+    def start_listener():
+        listener = QueueListener(records, *handlers,
+                                 respect_handler_level=True)
+        listener.start()
+        app.extensions['log_listener'] = listener
+
+    start_listener()
+    atexit.register(flush_logs, app)
+    # threads do not survive a fork, so forked workers of a preloaded app
+    # replace the listener of the parent with their own
+    os.register_at_fork(after_in_child=start_listener)
+    queue_handler = RequestQueueHandler(records)
+    queue_handler.setLevel(logging.INFO)
+    # everything goes through the queue, including what Flask would write
+    # to the error stream of the server
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+    access_logger = logging.getLogger('genblog.access')
+    access_logger.handlers = [queue_handler]
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+    # before the other request hooks, which may log
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_log_request)
+
+
+def flush_logs(app):
+    """
+    Stop the log listener of the process once it has handled the records
+    that are queued. Processes that exit with os._exit(), such as the forked
+    processes of the task worker, skip the atexit hook that does this and
+    must call it before they exit, or their last records are lost.
+
+    Args:
+        app (Flask): The application.
+    """
+    listener = app.extensions.pop('log_listener', None)
+    if listener is not None:
+        listener.stop()
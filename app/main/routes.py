@@ -1,21 +1,23 @@
-from datetime import datetime, timezone
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+import json
+import os
+from time import time
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, Response, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+import redis
+from app import avatars, db, exports, language, presence, timeline, versions
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification, Comment
-from app.translate import translate
+from app.models import User, Post, Message, Notification
+from app.pagination import paginate
+from app.translate import translate, translate_batch, TranslationError
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        presence.record_seen(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -26,21 +28,24 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        timeline.schedule_fan_out(post)
+        language.schedule_detection(post)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts = timeline.get_page(current_user, cursor, per_page)
+    if posts is None:
+        if cursor is None:
+            timeline.schedule_rebuild(current_user)
+        posts = paginate(current_user.following_posts(),
+                         (Post.timestamp, Post.id), cursor, per_page)
+    Post.load_card_stats(posts.items, current_user)
+    next_url = url_for('main.index', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) if posts.has_prev else None
     return render_template('index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
                            prev_url=prev_url)
@@ -49,40 +54,54 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    etag = versions.page_etag([versions.POSTS])
+    if versions.is_fresh(etag):
+        return versions.not_modified(etag)
+    cursor = request.args.get('cursor')
+    posts = paginate(sa.select(Post), (Post.timestamp, Post.id), cursor,
+                     current_app.config['POSTS_PER_PAGE'])
+    Post.load_card_stats(posts.items, current_user)
+    next_url = url_for('main.explore', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) if posts.has_prev else None
+    return versions.tagged(render_template(
+        'index.html', title=_('Explore'), posts=posts.items,
+        next_url=next_url, prev_url=prev_url), etag)
 
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    presence.load_last_seen(user)
+    export_ready = user == current_user and os.path.exists(
+        exports.export_path(current_app.config['EXPORT_DIR'], user))
+    etag = versions.page_etag([versions.user_key(user.id)], user.last_seen,
+                              export_ready)
+    if versions.is_fresh(etag):
+        return versions.not_modified(etag)
+    cursor = request.args.get('cursor')
+    posts = paginate(user.posts.select(), (Post.timestamp, Post.id), cursor,
+                     current_app.config['POSTS_PER_PAGE'])
+    Post.load_card_stats(posts.items, current_user)
+    next_url = url_for('main.user', username=user.username, cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username, cursor=posts.prev_cursor) if posts.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    return versions.tagged(render_template(
+        'user.html', user=user, posts=posts.items, next_url=next_url,
+        prev_url=prev_url, form=form, export_ready=export_ready), etag)
 
 
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
+    presence.load_last_seen(user)
+    etag = versions.page_etag([versions.user_key(user.id)], user.last_seen)
+    if versions.is_fresh(etag):
+        return versions.not_modified(etag)
     form = EmptyForm()
-    return render_template('user_popup.html', user=user, form=form)
+    return versions.tagged(
+        render_template('user_popup.html', user=user, form=form), etag)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -115,6 +134,7 @@ def follow(username):
             return redirect(url_for('main.user', username=username))
         current_user.follow(user)
         db.session.commit()
+        timeline.add_author(current_user, user)
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -135,6 +155,7 @@ def unfollow(username):
             return redirect(url_for('main.user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        timeline.remove_author(current_user, user)
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -177,8 +198,7 @@ def comment_post(post_id):
     comment_body = data.get('comment')
     if not comment_body or len(comment_body) > 140:
         return jsonify({'error': 'Comment must be 1-140 characters'}), 400
-    comment = Comment(body=comment_body, author=current_user, post=post)
-    db.session.add(comment)
+    comment = current_user.comment_on_post(post, comment_body)
     if post.author != current_user:
         post.author.add_notification('post_commented', {
             'user_id': current_user.id,
@@ -199,17 +219,60 @@ def comment_post(post_id):
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not all(
+            isinstance(data.get(field), str)
+            for field in ('text', 'source_language', 'dest_language')):
+        return _invalid_translation_request()
     return {'text': translate(data['text'], data['source_language'], data['dest_language'])}
 
 
+def _invalid_translation_request():
+    return jsonify({'error': _('Error: invalid translation request.')}), 400
+
+
+@bp.route('/translate/posts', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('dest_language'), str) or \
+            not isinstance(data.get('post_ids', []), list):
+        return _invalid_translation_request()
+    try:
+        ids = [int(id) for id in data.get('post_ids', [])][:100]
+    except (TypeError, ValueError):
+        return _invalid_translation_request()
+    dest_language = data['dest_language']
+    by_language = {}
+    for post in db.session.scalars(sa.select(Post).where(Post.id.in_(ids))):
+        if post.language and post.language != dest_language:
+            by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    try:
+        # one upstream request per source language, usually just one
+        for language, posts in by_language.items():
+            texts = translate_batch([post.body for post in posts], language,
+                                    dest_language)
+            translations.update({str(post.id): text
+                                 for post, text in zip(posts, texts)})
+    except TranslationError as e:
+        current_app.logger.warning(f'Translation error: {e}')
+        return jsonify({'error': _('Error: the translation service failed.')}), 503
+    return {'translations': translations}
+
+
 @bp.route('/search')
 @login_required
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    if current_app.config['SEARCH_RESULTS_FROM_INDEX']:
+        posts, total = Post.search_hits(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    else:
+        posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    Post.load_card_stats(posts, current_user)
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -225,8 +288,8 @@ def send_message(recipient):
     form = MessageForm()
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
-        db.session.add(msg)
-        user.add_notification('unread_message_count', user.unread_message_count())
+        user.add_notification('unread_message_count',
+                              user.receive_message(msg))
         db.session.commit()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
@@ -237,16 +300,15 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
+    current_user.read_messages()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) if messages.has_prev else None
+    cursor = request.args.get('cursor')
+    messages = paginate(current_user.messages_received.select(),
+                        (Message.timestamp, Message.id), cursor,
+                        current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.messages', cursor=messages.next_cursor) if messages.has_next else None
+    prev_url = url_for('main.messages', cursor=messages.prev_cursor) if messages.has_prev else None
     return render_template('messages.html', messages=messages.items,
                            next_url=next_url, prev_url=prev_url)
 
@@ -262,6 +324,37 @@ def export_posts():
     return redirect(url_for('main.user', username=current_user.username))
 
 
+@bp.route('/export_posts/download')
+@login_required
+def download_posts_export():
+    path = exports.export_path(current_app.config['EXPORT_DIR'], current_user)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     download_name='posts.ndjson.gz')
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+@login_required
+def avatar(digest, size):
+    # only the avatars of users are proxied, in the sizes the pages use
+    if not current_app.config['AVATAR_PROXY'] or \
+            not avatars.valid_request(digest, size) or \
+            db.session.scalar(sa.select(User.id).where(
+                User.avatar_hash == digest).limit(1)) is None:
+        abort(404)
+    cached = avatars.fetch_avatar(digest, size)
+    if cached is None:
+        return redirect(avatars.gravatar_url(digest, size))
+    path, mimetype = cached
+    try:
+        return send_file(path, mimetype=mimetype,
+                         max_age=current_app.config['AVATAR_CACHE_MAX_AGE'])
+    except FileNotFoundError:
+        # deleted from the cache in the meantime
+        return redirect(avatars.gravatar_url(digest, size))
+
+
 @bp.route('/notifications')
 @login_required
 def notifications():
@@ -276,6 +369,57 @@ def notifications():
     } for n in notifications]
 
 
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(current_user.id))
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Notification stream error: {e}')
+        # the client falls back to polling
+        return {'error': 'Notification stream unavailable'}, 503
+    # notifications that were added before the subscription started
+    query = current_user.notifications.select().where(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    missed = [{
+        'name': n.name,
+        'data': n.get_data(),
+        'timestamp': n.timestamp
+    } for n in db.session.scalars(query)]
+    # the stream does not use the database, so the connection is returned
+    # to the pool instead of being held for the life of the stream
+    db.session.remove()
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    def events():
+        def event(notification):
+            return f'id: {notification["timestamp"]}\n' \
+                f'data: {json.dumps(notification)}\n\n'
+
+        try:
+            for notification in missed:
+                yield event(notification)
+            # the client reconnects with the last event id when this ends
+            end = time() + timeout
+            while time() < end:
+                message = pubsub.get_message(timeout=keepalive)
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield event(json.loads(message['data']))
+        except redis.exceptions.RedisError:
+            pass
+        finally:
+            pubsub.close()
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/privacy')
 def privacy():
     return render_template('privacy.html', title=_('Privacy Policy'))
@@ -1,19 +1,25 @@
-from datetime import datetime, timezone
-from hashlib import md5
+from collections import deque
+from datetime import datetime, timedelta, timezone
 import json
+import multiprocessing
+import secrets
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from flask import current_app
+from sqlalchemy.dialects import postgresql, sqlite
+from flask import current_app, url_for
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
+from markupsafe import Markup
 import redis
-import rq
 
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, login, versions
+from app.avatars import avatar_url, email_digest
+from app.pagination import paginate
+from app.search import bulk_update_index, get_backend, query_index, \
+    record_dead_letters
 
 
 class SearchableMixin:
@@ -25,52 +31,352 @@ class SearchableMixin:
         """
         Search for records matching the given expression.
         """
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = query_index(cls.__tablename__, expression, page, per_page,
+                                 fields=cls.__searchable__)
         if total == 0:
             return [], 0
         when = [(ids[i], i) for i in range(len(ids))]
         query = sa.select(cls).where(cls.id.in_(ids)).order_by(
             db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
+        return db.session.scalars(query).all(), total
 
     @classmethod
-    def before_commit(cls, session):
+    def search_hits(cls, expression, page, per_page):
         """
-        Store changes before committing the session.
+        Search for records matching the given expression, and build the
+        results from the documents stored in the index instead of loading
+        the records from the database.
         """
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+        hits, total = query_index(cls.__tablename__, expression, page,
+                                  per_page, fields=cls.__searchable__,
+                                  source=True)
+        return [cls.from_search_hit(hit) for hit in hits], total
+
+    @classmethod
+    def from_search_hit(cls, hit):
+        """
+        Build a search result from a search hit.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def search_query(cls):
+        """
+        Return the query that loads records for indexing.
+        """
+        return sa.select(cls)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Record the search index changes of a flush in the index outbox, in
+        the same transaction as the changes themselves. Backends that live
+        in the database apply the changes directly instead, and only fall
+        back to the outbox if that fails.
+        """
+        backend = get_backend()
+        if backend is None:
+            return
+        rows = []
+        actions = []
+        for op, objs in (('index', session.new), ('index', session.dirty),
+                         ('delete', session.deleted)):
+            for obj in objs:
+                if not isinstance(obj, SearchableMixin):
+                    continue
+                state = sa.inspect(obj)
+                if obj in session.dirty and not any(
+                        state.attrs[field].history.has_changes()
+                        for field in obj.__searchable__ +
+                        getattr(obj, '__search_stored__', [])):
+                    continue
+                rows.append({'index_name': obj.__tablename__,
+                             'object_id': obj.id, 'op': op})
+                actions.append((obj.__tablename__, op, obj.id,
+                                obj.search_document() if op == 'index'
+                                else None))
+        if actions and backend.inline:
+            try:
+                with session.connection().begin_nested():
+                    backend.update(session.connection(), actions)
+                rows = []
+            except sa.exc.SQLAlchemyError as e:
+                current_app.logger.warning(f'Search index update error: {e}')
+        if rows:
+            session.connection().execute(
+                sa.insert(IndexOutbox.__table__), rows)
+            session.info['index_outbox'] = True
+        # records whose documents copy fields of a changed record
+        for obj in session.dirty:
+            if not hasattr(obj, 'search_dependents'):
+                continue
+            query = obj.search_dependents()
+            if query is not None:
+                session.connection().execute(
+                    sa.insert(IndexOutbox.__table__).from_select(
+                        ['index_name', 'object_id', 'op'], query))
+                session.info['index_outbox'] = True
 
     @classmethod
     def after_commit(cls, session):
         """
-        Update the search index after committing the session.
+        Start draining the index outbox if the commit added to it.
         """
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        if session.info.pop('index_outbox', False):
+            try:
+                current_app.task_queue.enqueue('app.tasks.drain_index_outbox')
+            except redis.exceptions.RedisError as e:
+                current_app.logger.warning(f'Search index queue error: {e}')
 
     @classmethod
-    def reindex(cls):
+    def after_rollback(cls, session):
+        session.info.pop('index_outbox', None)
+
+    @staticmethod
+    def apply_index_changes(changes):
+        """
+        Apply index changes with the bulk API. Repeated changes to the same
+        object are coalesced, and objects are read from the database at
+        this time, so the index receives their latest state.
+
+        Args:
+            changes (list): A list of [index, id, op] changes, in order.
+
+        Returns:
+            list: A list of (index, op, id, error) tuples for the changes
+                that failed.
+        """
+        models = SearchableMixin.searchable_models()
+        pending = {}
+        for index, id, op in changes:
+            pending.setdefault(index, {})[id] = op
+        actions = []
+        # a separate session, so that the caller's transaction is not held
+        with so.Session(db.engine) as session:
+            for index, ops in pending.items():
+                model = models[index]
+                ids = [id for id, op in ops.items() if op == 'index']
+                objs = {obj.id: obj for obj in session.scalars(
+                    model.search_query().where(model.id.in_(ids)))} \
+                    if ids else {}
+                for id, op in ops.items():
+                    obj = objs.get(id)
+                    if op == 'index' and obj is not None:
+                        actions.append(
+                            (index, 'index', id, obj.search_document()))
+                    else:
+                        actions.append((index, 'delete', id, None))
+        return bulk_update_index(actions)
+
+    def search_document(self):
         """
-        Reindex all records of the model.
+        Return the document stored in the search index for this record.
+        """
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    @staticmethod
+    def searchable_models():
+        """
+        Return the searchable models, keyed by their index name.
+        """
+        return {mapper.class_.__tablename__: mapper.class_
+                for mapper in db.Model.registry.mappers
+                if issubclass(mapper.class_, SearchableMixin)}
+
+    @classmethod
+    def index_range(cls, index, first_id, last_id):
         """
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+        Index the records of the model in a primary key range with the bulk
+        API.
 
+        Args:
+            index (str): The name of the index to write to.
+            first_id (int): The first primary key of the range.
+            last_id (int): The last primary key of the range.
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+        Returns:
+            tuple: A tuple containing the last primary key of the range, the
+                number of records indexed and the number that failed.
+        """
+        with so.Session(db.engine) as session:
+            actions = [(index, 'index', obj.id, obj.search_document())
+                       for obj in session.scalars(
+                           cls.search_query()
+                           .where(cls.id.between(first_id, last_id))
+                           .order_by(cls.id))]
+        failed = bulk_update_index(actions)
+        if failed:
+            record_dead_letters(failed)
+        return last_id, len(actions) - len(failed), len(failed)
+
+    @classmethod
+    def reindex(cls, chunk_size=1000, workers=1, resume=True, index=None,
+                progress=None):
+        """
+        Reindex all records of the model. Primary keys are read in chunks
+        by key, and each chunk is loaded and sent to the index with the bulk
+        API, by a pool of worker processes if more than one worker is
+        requested. The last indexed primary key is saved after each chunk,
+        so an interrupted run resumes where it stopped.
+
+        Args:
+            chunk_size (int): The number of records indexed per bulk request.
+            workers (int): The number of worker processes.
+            resume (bool): Whether to resume from the saved checkpoint.
+            index (str): The name of the index to write to, by default the
+                model's index alias.
+            progress (callable): Called after each chunk with the number of
+                records indexed, failed, and the elapsed seconds.
+
+        Returns:
+            tuple: A tuple containing the number of records indexed and the
+                number that failed.
+        """
+        index = index or cls.__tablename__
+        checkpoint = f'search:reindex:{index}'
+        start_id = 0
+        try:
+            if resume:
+                start_id = int(current_app.redis.get(checkpoint) or 0)
+            else:
+                current_app.redis.delete(checkpoint)
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Reindex checkpoint error: {e}')
+            checkpoint = None
+
+        def chunks():
+            # each chunk of keys is read by a short query that is finished
+            # before the chunk is indexed, since a read that stays open
+            # blocks the writes of other connections on SQLite
+            last_id = start_id
+            while True:
+                with db.engine.connect() as connection:
+                    ids = connection.scalars(
+                        sa.select(cls.id).where(cls.id > last_id)
+                        .order_by(cls.id).limit(chunk_size)).all()
+                if not ids:
+                    return
+                last_id = ids[-1]
+                yield index, ids[0], ids[-1]
+
+        started = time()
+        indexed = failed = 0
+
+        def done(result):
+            nonlocal indexed, failed
+            last_id, ok, errors = result
+            indexed += ok
+            failed += errors
+            if checkpoint:
+                try:
+                    current_app.redis.set(checkpoint, last_id)
+                except redis.exceptions.RedisError as e:
+                    current_app.logger.warning(f'Reindex checkpoint error: {e}')
+            if progress:
+                progress(indexed, failed, time() - started)
+
+        if workers > 1:
+            # a few chunks are kept in flight per worker, and their results
+            # are collected in key order, so the checkpoint never skips over
+            # a chunk that is still being indexed
+            with multiprocessing.Pool(
+                    workers, initializer=_reindex_init,
+                    initargs=(current_app.config_object,)) as pool:
+                pending = deque()
+                for chunk in chunks():
+                    pending.append(pool.apply_async(
+                        _reindex_chunk, (cls.__tablename__, chunk)))
+                    if len(pending) >= 2 * workers:
+                        done(pending.popleft().get())
+                while pending:
+                    done(pending.popleft().get())
+        else:
+            for chunk in chunks():
+                done(cls.index_range(*chunk))
+        if checkpoint:
+            try:
+                current_app.redis.delete(checkpoint)
+            except redis.exceptions.RedisError:
+                pass
+        return indexed, failed
+
+
+def _reindex_init(config_class):
+    # each worker process runs its own application and connections, with
+    # the configuration of the application that started the reindex
+    from app import create_app
+    create_app(config_class).app_context().push()
+
+
+def _reindex_chunk(tablename, chunk):
+    model = SearchableMixin.searchable_models()[tablename]
+    return model.index_range(*chunk)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+def increment(obj, counter, delta):
+    """
+    Atomically add to a counter column of a model instance with an
+    UPDATE ... SET counter = counter + delta statement.
+
+    Args:
+        obj (Model): The model instance that owns the counter.
+        counter (str): The name of the counter column.
+        delta (int): The amount to add to the counter.
+    """
+    model = type(obj)
+    db.session.execute(sa.update(model).where(model.id == obj.id).values(
+        {counter: getattr(model, counter) + delta}))
+    if isinstance(obj, Post):
+        versions.mark_changed(versions.POSTS, versions.user_key(obj.user_id))
+    else:
+        versions.mark_changed(versions.user_key(obj.id))
+
+
+class PaginatedAPIMixin:
+    """
+    Mixin class to serialize cursor paginated collections for the API.
+    """
+    @classmethod
+    def to_dicts(cls, items, fields=None):
+        """
+        Serialize a list of resources. Models override this to load what
+        their serialization needs for the whole list at once.
+        """
+        return [item.to_dict(fields=fields) for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, cursor, per_page, endpoint,
+                           fields=None, **kwargs):
+        """
+        Serialize one page of a query, keyed on the model's primary key.
+        When fields is given, only those fields of each item are included.
+        """
+        resources = paginate(query, (cls.id,), cursor, per_page)
+        if fields is not None:
+            kwargs['fields'] = ','.join(fields)
+        return {
+            'items': cls.to_dicts(resources.items, fields=fields),
+            '_meta': {
+                'per_page': per_page,
+                'next_cursor': resources.next_cursor,
+                'prev_cursor': resources.prev_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_prev else None
+            }
+        }
 
 followers = sa.Table(
     'followers',
@@ -87,17 +393,23 @@ post_likes = sa.Table(
 )
 
 
-class User(UserMixin, db.Model):
+class User(PaginatedAPIMixin, UserMixin, db.Model):
     """
     User model for storing user details and authentication.
     """
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    avatar_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True)
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
     last_message_read_time: so.Mapped[Optional[datetime]]
+    num_unread_messages: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
+    token_expiration: so.Mapped[Optional[datetime]]
 
     posts: so.WriteOnlyMapped['Post'] = so.relationship(back_populates='author')
     following: so.WriteOnlyMapped['User'] = so.relationship(
@@ -127,53 +439,90 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @so.validates('email')
+    def validate_email(self, key, email):
+        self.avatar_hash = email_digest(email) if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return avatar_url(self.avatar_digest(), size)
+
+    def avatar_digest(self):
+        return self.avatar_hash or email_digest(self.email)
+
+    def search_dependents(self):
+        """
+        Return a query for the index changes of the posts of this user, if
+        the author fields copied into their search documents changed.
+        """
+        state = sa.inspect(self)
+        if not any(state.attrs[field].history.has_changes()
+                   for field in ('username', 'email')):
+            return None
+        return sa.select(sa.literal(Post.__tablename__), Post.id,
+                         sa.literal('index')).where(Post.user_id == self.id)
 
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            increment(self, 'num_following', 1)
+            increment(user, 'num_followers', 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            increment(self, 'num_following', -1)
+            increment(user, 'num_followers', -1)
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.num_followers
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(self.following.select().subquery())
+        return self.num_following
+
+    def posts_count(self):
+        query = sa.select(sa.func.count()).select_from(self.posts.select().subquery())
         return db.session.scalar(query)
 
     def following_posts(self):
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
+        # a filter on the author instead of joins, so that posts are read in
+        # feed order from the post indexes without grouping or sorting
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
         return (
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
-            .where(sa.or_(Follower.id == self.id, Author.id == self.id))
-            .group_by(Post)
+            .where(sa.or_(Post.user_id.in_(followed), Post.user_id == self.id))
             .order_by(Post.timestamp.desc())
         )
 
     def has_liked_post(self, post):
+        cache = self.__dict__.get('_liked_post_cache')
+        if cache is not None and post.id in cache:
+            return cache[post.id]
         query = self.liked_posts.select().where(Post.id == post.id)
         return db.session.scalar(query) is not None
 
     def like_post(self, post):
         if not self.has_liked_post(post):
             self.liked_posts.add(post)
+            increment(post, 'num_likes', 1)
+            self.__dict__.pop('_liked_post_cache', None)
 
     def unlike_post(self, post):
         if self.has_liked_post(post):
             self.liked_posts.remove(post)
+            increment(post, 'num_likes', -1)
+            self.__dict__.pop('_liked_post_cache', None)
+
+    def comment_on_post(self, post, body):
+        comment = Comment(body=body, author=self, post=post)
+        db.session.add(comment)
+        increment(post, 'num_comments', 1)
+        return comment
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -189,30 +538,193 @@ class User(UserMixin, db.Model):
             return
         return db.session.get(User, id)
 
+    def get_token(self, expires_in=3600):
+        """
+        Return the API token of the user, issuing a new one if the current
+        token expires in less than a minute.
+        """
+        now = datetime.now(timezone.utc)
+        if self.token and self.token_expiration.replace(
+                tzinfo=timezone.utc) > now + timedelta(seconds=60):
+            return self.token
+        if self.token:
+            self._forget_token()
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        """
+        Expire the API token of the user. The cached token is dropped when
+        the session commits.
+        """
+        self.token_expiration = datetime.now(timezone.utc) - \
+            timedelta(seconds=1)
+        self._forget_token()
+
+    def _forget_token(self):
+        db.session.info.setdefault('revoked_tokens', []).append(self.token)
+
+    @staticmethod
+    def token_cache_key(token):
+        return f'token:{token}'
+
+    @staticmethod
+    def check_token(token):
+        """
+        Return the user that owns a valid API token, or None. Tokens are
+        cached in Redis until they expire, so a token that was verified once
+        is resolved without searching the user table.
+        """
+        key = User.token_cache_key(token)
+        try:
+            user_id = current_app.redis.get(key)
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Token cache error: {e}')
+            user_id = key = None
+        if user_id is not None:
+            return db.session.get(User, int(user_id))
+        user = db.session.scalar(sa.select(User).where(User.token == token))
+        if user is None:
+            return None
+        remaining = (user.token_expiration.replace(tzinfo=timezone.utc) -
+                     datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0:
+            return None
+        if key is not None and int(remaining) > 0:
+            try:
+                current_app.redis.set(key, user.id, ex=int(remaining))
+            except redis.exceptions.RedisError as e:
+                current_app.logger.warning(f'Token cache error: {e}')
+        return user
+
+    @staticmethod
+    def after_commit(session):
+        """
+        Drop the revoked and replaced tokens from the token cache.
+        """
+        revoked = session.info.pop('revoked_tokens', None)
+        if not revoked:
+            return
+        try:
+            current_app.redis.delete(*[User.token_cache_key(token)
+                                       for token in revoked])
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Token cache error: {e}')
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('revoked_tokens', None)
+
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+        return self.num_unread_messages
+
+    def receive_message(self, message):
+        """
+        Add a message for this user and return the new unread count.
+        """
+        db.session.add(message)
+        increment(self, 'num_unread_messages', 1)
+        return db.session.scalar(sa.select(User.num_unread_messages).where(
+            User.id == self.id))
+
+    def read_messages(self):
+        self.last_message_read_time = datetime.now(timezone.utc)
+        self.num_unread_messages = 0
+        versions.mark_changed(versions.user_key(self.id))
+
+    def add_notification(self, name, data, force=False):
+        """
+        Set the user's notification of the given name, replacing the
+        previous one. Names listed in NOTIFICATION_COALESCE are written to
+        the database at most once per interval, and the latest value of an
+        interval is written when it ends. Every notification is published
+        to the notification stream once the session commits.
+        """
+        timestamp = time()
+        db.session.info.setdefault('notifications', []).append(
+            (self.id, {'name': name, 'data': data, 'timestamp': timestamp}))
+        interval = current_app.config['NOTIFICATION_COALESCE'].get(name)
+        if interval and not force and Notification.defer(
+                self.id, name, data, timestamp, interval):
+            return
+        Notification.store(self.id, name, data, timestamp)
+
+    def to_dict(self, include_email=False, fields=None, post_count=None):
+        """
+        Serialize the user for the API. When fields is given, only those
+        fields are included, and the ones that were not asked for are not
+        computed. The post count is queried unless it is given.
+        """
+        getters = {
+            'id': lambda: self.id,
+            'username': lambda: self.username,
+            'last_seen': lambda: self.last_seen.replace(
+                tzinfo=timezone.utc).isoformat() if self.last_seen else None,
+            'about_me': lambda: self.about_me,
+            'post_count': lambda: self.posts_count()
+            if post_count is None else post_count,
+            'follower_count': self.followers_count,
+            'following_count': self.following_count,
+            '_links': lambda: {
+                'self': url_for('api.get_user', id=self.id),
+                'followers': url_for('api.get_followers', id=self.id),
+                'following': url_for('api.get_following', id=self.id),
+                'avatar': self.avatar(128)
+            }
+        }
+        if include_email:
+            getters['email'] = lambda: self.email
+        return {name: getter() for name, getter in getters.items()
+                if fields is None or name in fields or name == 'id'}
+
+    @classmethod
+    def to_dicts(cls, users, fields=None):
+        """
+        Serialize a list of users, counting the posts of all of them in one
+        grouped query.
+        """
+        post_counts = {}
+        if users and (fields is None or 'post_count' in fields):
+            post_counts = dict(db.session.execute(
+                sa.select(Post.user_id, sa.func.count())
+                .where(Post.user_id.in_([user.id for user in users]))
+                .group_by(Post.user_id)).all())
+        return [user.to_dict(fields=fields,
+                             post_count=post_counts.get(user.id, 0))
+                for user in users]
 
-    def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+    def from_dict(self, data, new_user=False):
+        for field in ['username', 'email', 'about_me']:
+            if field in data:
+                setattr(self, field, data[field])
+        if new_user and 'password' in data:
+            self.set_password(data['password'])
 
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task)
+        Task.track(self.id, task.id, description)
         return task
 
     def get_tasks_in_progress(self):
-        query = self.tasks.select().where(not Task.complete)
-        return db.session.scalars(query)
+        """
+        Return the progress of the user's tasks that are in progress, read
+        from Redis in one round trip. Without Redis, the tasks are read from
+        the database.
+        """
+        progress = Task.tracked(self.id)
+        if progress is not None:
+            return progress
+        query = self.tasks.select().where(Task.complete.is_(False))
+        return [TaskProgress(task.id, task.description, task.get_progress())
+                for task in db.session.scalars(query)]
 
     def get_task_in_progress(self, name):
-        query = self.tasks.select().where(Task.name == name, not Task.complete)
+        query = self.tasks.select().where(Task.name == name,
+                                          Task.complete.is_(False))
         return db.session.scalar(query)
 
 
@@ -221,16 +733,33 @@ def load_user(id):
     return db.session.get(User, int(id))
 
 
+db.event.listen(db.session, 'after_commit', User.after_commit)
+db.event.listen(db.session, 'after_rollback', User.after_rollback)
+
+
 class Post(SearchableMixin, db.Model):
     """
     Post model for storing user posts.
     """
+    # in the key order of the feeds, which page by (timestamp, id)
+    __table_args__ = (
+        sa.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        sa.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp',
+                 'id')
+    )
     __searchable__ = ['body']
+    # copied into the search document, but not searched
+    __search_stored__ = ['timestamp', 'language', 'user_id']
+    __search_mapping__ = {
+        'author': {'properties': {'username': {'type': 'keyword'}}}
+    }
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
-    timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
+    num_likes: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_comments: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     liked_by: so.WriteOnlyMapped[User] = so.relationship(secondary=post_likes, back_populates='liked_posts')
@@ -241,13 +770,114 @@ class Post(SearchableMixin, db.Model):
 
     @property
     def like_count(self):
-        query = sa.select(sa.func.count()).select_from(self.liked_by.select().subquery())
-        return db.session.scalar(query)
+        return self.num_likes
 
     @property
     def comment_count(self):
-        query = sa.select(sa.func.count()).select_from(self.comments.select().subquery())
-        return db.session.scalar(query)
+        return self.num_comments
+
+    def search_document(self):
+        """
+        Return the search document of the post, with everything a search
+        result card shows, including a copy of the author's details.
+        """
+        return {
+            'body': self.body,
+            'timestamp': self.timestamp.isoformat(),
+            'language': self.language,
+            'user_id': self.user_id,
+            'author': {
+                'username': self.author.username,
+                'avatar': self.author.avatar_digest()
+            } if self.author else None
+        }
+
+    @classmethod
+    def search_query(cls):
+        return sa.select(cls).options(so.joinedload(cls.author))
+
+    @classmethod
+    def from_search_hit(cls, hit):
+        return PostHit(hit)
+
+    @staticmethod
+    def load_card_stats(posts, viewer=None):
+        """
+        Load everything the post cards of a page need in a constant number
+        of queries: the authors, the counters of posts built from search
+        hits, and which of the posts the viewer has liked.
+        """
+        posts = [post for post in posts if isinstance(post, (Post, PostHit))]
+        if not posts:
+            return
+        ids = [post.id for post in posts]
+        hits = [post for post in posts if isinstance(post, PostHit)]
+        posts = [post for post in posts if isinstance(post, Post)]
+        if posts:
+            authors = {user.id: user for user in db.session.scalars(
+                sa.select(User).where(
+                    User.id.in_({p.user_id for p in posts})))}
+            for post in posts:
+                if 'author' not in post.__dict__ and post.user_id in authors:
+                    so.attributes.set_committed_value(
+                        post, 'author', authors[post.user_id])
+        if hits:
+            counts = {row.id: row for row in db.session.execute(
+                sa.select(Post.id, Post.num_likes, Post.num_comments).where(
+                    Post.id.in_([hit.id for hit in hits])))}
+            for hit in hits:
+                if hit.id in counts:
+                    hit.num_likes = counts[hit.id].num_likes
+                    hit.num_comments = counts[hit.id].num_comments
+        if viewer is not None and viewer.is_authenticated:
+            liked = set(db.session.scalars(
+                sa.select(post_likes.c.post_id).where(
+                    post_likes.c.user_id == viewer.id,
+                    post_likes.c.post_id.in_(ids))))
+            cache = viewer.__dict__.setdefault('_liked_post_cache', {})
+            cache.update({id: id in liked for id in ids})
+
+
+class PostHit:
+    """
+    A post search result built from its search document, which renders in
+    the post card template like a post.
+    """
+    def __init__(self, hit):
+        source = hit['source']
+        self.id = hit['id']
+        self.body = Markup(hit['highlight']['body']) \
+            if 'body' in hit['highlight'] else source['body']
+        self.timestamp = datetime.fromisoformat(source['timestamp'])
+        self.language = source.get('language')
+        self.user_id = source.get('user_id')
+        self.author = PostHitAuthor(**source['author']) \
+            if source.get('author') else None
+        # loaded from the database by Post.load_card_stats()
+        self.num_likes = self.num_comments = 0
+
+    def __repr__(self):
+        return '<PostHit {}>'.format(self.id)
+
+    @property
+    def like_count(self):
+        return self.num_likes
+
+    @property
+    def comment_count(self):
+        return self.num_comments
+
+
+class PostHitAuthor:
+    """
+    The author details copied into a post search document.
+    """
+    def __init__(self, username, avatar):
+        self.username = username
+        self.avatar_digest = avatar
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_digest, size)
 
 
 class Comment(db.Model):
@@ -271,9 +901,14 @@ class Message(db.Model):
     """
     Message model for storing user messages.
     """
+    # also serves lookups by recipient alone
+    __table_args__ = (
+        sa.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+                 'timestamp'),
+    )
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
-    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
 
@@ -296,9 +931,115 @@ class Notification(db.Model):
 
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
+    __table_args__ = (
+        sa.UniqueConstraint('user_id', 'name',
+                            name='uq_notification_user_id_name'),
+    )
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @classmethod
+    def store(cls, user_id, name, data, timestamp):
+        """
+        Insert or update the notification of a user with a single upsert.
+        An older notification never replaces a newer one.
+        """
+        values = {'user_id': user_id, 'name': name, 'timestamp': timestamp,
+                  'payload_json': json.dumps(data)}
+        dialect = db.session.get_bind().dialect.name
+        if dialect not in ('postgresql', 'sqlite'):
+            db.session.execute(sa.delete(cls).where(
+                cls.user_id == user_id, cls.name == name))
+            db.session.execute(sa.insert(cls).values(values))
+            return
+        insert = postgresql.insert(cls) if dialect == 'postgresql' \
+            else sqlite.insert(cls)
+        insert = insert.values(values)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['user_id', 'name'],
+            set_={'timestamp': insert.excluded.timestamp,
+                  'payload_json': insert.excluded.payload_json},
+            where=cls.timestamp <= insert.excluded.timestamp))
+
+    @classmethod
+    def defer(cls, user_id, name, data, timestamp, interval):
+        """
+        Hold back the write of a notification if one of the same name was
+        written less than interval seconds ago. The latest held back
+        notification is written by a task queued for the end of the
+        interval.
+
+        Returns:
+            bool: True if the write was held back, False if it should be
+                written now.
+        """
+        key = f'notification:{user_id}:{name}'
+        try:
+            if current_app.redis.set(f'{key}:window', 1, nx=True,
+                                     px=int(interval * 1000)):
+                return False
+            pipe = current_app.redis.pipeline()
+            pipe.hset('notification:pending', f'{user_id}:{name}',
+                      json.dumps([data, timestamp]))
+            pipe.set(f'{key}:flush', 1, nx=True, px=int(interval * 1000))
+            _, schedule = pipe.execute()
+            if schedule:
+                current_app.task_queue.enqueue_in(
+                    timedelta(seconds=interval),
+                    'app.tasks.flush_notification', user_id, name)
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Notification coalescing error: {e}')
+            return False
+        return True
+
+    @classmethod
+    def flush(cls, user_id, name):
+        """
+        Write the latest held back notification of a user, if there is one.
+        """
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hget('notification:pending', f'{user_id}:{name}')
+            pipe.hdel('notification:pending', f'{user_id}:{name}')
+            pending, _ = pipe.execute()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Notification coalescing error: {e}')
+            return
+        if pending:
+            data, timestamp = json.loads(pending)
+            cls.store(user_id, name, data, timestamp)
+            db.session.commit()
+
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+    @classmethod
+    def after_commit(cls, session):
+        """
+        Publish the notifications added in the committed transaction to the
+        Redis channels of their users.
+        """
+        pending = session.info.pop('notifications', None)
+        if not pending:
+            return
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id, notification in pending:
+                pipe.publish(cls.channel(user_id), json.dumps(notification))
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Notification publish error: {e}')
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
+
 
 class Task(db.Model):
     """
@@ -313,6 +1054,7 @@ class Task(db.Model):
     user: so.Mapped[User] = so.relationship(back_populates='tasks')
 
     def get_rq_job(self):
+        import rq
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
@@ -321,4 +1063,148 @@ class Task(db.Model):
 
     def get_progress(self):
         job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
\ No newline at end of file
+        return job.meta.get('progress', 0) if job is not None else 100
+
+    @staticmethod
+    def status_keys(user_id):
+        """
+        Return the Redis keys that track the tasks of a user in progress:
+        a hash of task id -> description and start time, and a hash of task
+        id -> progress.
+        """
+        return f'tasks:{user_id}', f'tasks:{user_id}:progress'
+
+    @staticmethod
+    def track(user_id, task_id, description):
+        """
+        Start tracking the progress of a new task.
+        """
+        tasks, progress = Task.status_keys(user_id)
+        ttl = current_app.config['TASK_STATUS_TTL']
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hset(tasks, task_id, json.dumps(
+                {'description': description, 'started': time()}))
+            pipe.hset(progress, task_id, 0)
+            pipe.expire(tasks, ttl)
+            pipe.expire(progress, ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Task status error: {e}')
+
+    @staticmethod
+    def record_progress(user_id, task_id, progress, complete=False):
+        """
+        Record the progress of a task. Tasks stop being tracked when they
+        reach 100 percent or are complete otherwise, and the tracking of
+        tasks that never complete expires TASK_STATUS_TTL seconds after
+        their last update.
+        """
+        keys = Task.status_keys(user_id)
+        ttl = current_app.config['TASK_STATUS_TTL']
+        try:
+            pipe = current_app.redis.pipeline()
+            if complete or progress >= 100:
+                for key in keys:
+                    pipe.hdel(key, task_id)
+            else:
+                pipe.hset(keys[1], task_id, progress)
+                for key in keys:
+                    pipe.expire(key, ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Task status error: {e}')
+
+    @staticmethod
+    def tracked(user_id):
+        """
+        Return the progress of the tasks of a user in progress, oldest
+        first, or None if Redis is not available.
+        """
+        try:
+            pipe = current_app.redis.pipeline()
+            for key in Task.status_keys(user_id):
+                pipe.hgetall(key)
+            tasks, progress = pipe.execute()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Task status error: {e}')
+            return None
+        result = []
+        for task_id, value in tasks.items():
+            status = json.loads(value)
+            result.append(TaskProgress(
+                task_id.decode('utf-8'), status['description'],
+                int(progress.get(task_id, 0)), status['started']))
+        return sorted(result, key=lambda task: task.started)
+
+
+class TaskProgress:
+    """
+    The progress of a task, as shown in the page banner.
+    """
+    def __init__(self, id, description, progress, started=0):
+        self.id = id
+        self.description = description
+        self.progress = progress
+        self.started = started
+
+
+class IndexOutbox(db.Model):
+    """
+    IndexOutbox model for storing search index changes until they are
+    applied to the search index.
+    """
+    __tablename__ = 'index_outbox'
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    index_name: so.Mapped[str] = so.mapped_column(sa.String(64))
+    object_id: so.Mapped[int]
+    op: so.Mapped[str] = so.mapped_column(sa.String(8))
+    attempts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    @classmethod
+    def drain(cls, batch_size=500):
+        """
+        Apply the pending changes to the search index in batches, oldest
+        first. A change is removed only after it has been applied, so every
+        change is applied at least once. Changes that keep failing are
+        moved to the dead letter list.
+
+        Args:
+            batch_size (int): The number of changes applied per batch.
+
+        Returns:
+            int: The number of changes that were applied.
+        """
+        applied = 0
+        while True:
+            rows = db.session.scalars(
+                sa.select(cls).order_by(cls.id).limit(batch_size)
+                .with_for_update(skip_locked=True)).all()
+            if not rows:
+                break
+            failed = SearchableMixin.apply_index_changes(
+                [[row.index_name, row.object_id, row.op] for row in rows])
+            errors = {(index, id): error for index, op, id, error in failed}
+            done = []
+            dead = []
+            for row in rows:
+                error = errors.get((row.index_name, row.object_id))
+                if error is None:
+                    done.append(row.id)
+                    continue
+                row.attempts += 1
+                if row.attempts >= current_app.config['SEARCH_INDEX_MAX_ATTEMPTS']:
+                    dead.append((row.index_name, row.op, row.object_id,
+                                 error))
+                    done.append(row.id)
+            db.session.execute(sa.delete(cls).where(cls.id.in_(done)))
+            db.session.commit()
+            if dead:
+                record_dead_letters(dead)
+            applied += sum(1 for row in rows
+                           if (row.index_name, row.object_id) not in errors)
+            if errors:
+                # leave the failed changes for the next drain
+                break
+        return applied
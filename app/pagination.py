@@ -0,0 +1,134 @@
+import base64
+from datetime import datetime
+import json
+import sqlalchemy as sa
+
+from app import db
+
+
+class CursorPagination:
+    """
+    A page of results from a keyset query.
+    """
+    def __init__(self, items, has_next, has_prev, next_cursor, prev_cursor):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(values, forward=True):
+    """
+    Encode the key values of a row into an opaque cursor.
+
+    Args:
+        values (list): The key values of the row.
+        forward (bool): Whether the cursor points to the rows after the row
+            (older rows) or before it (newer rows).
+
+    Returns:
+        str: The encoded cursor.
+    """
+    values = [v.isoformat() if isinstance(v, datetime) else v
+              for v in values]
+    data = json.dumps(['n' if forward else 'p', values],
+                      separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """
+    Decode an opaque cursor.
+
+    Args:
+        cursor (str): The encoded cursor.
+        columns (tuple): The key columns of the query.
+
+    Returns:
+        tuple: A tuple containing the direction of the cursor and the key
+            values, or (True, None) if the cursor is missing or invalid.
+    """
+    if not cursor:
+        return True, None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(data)
+        if direction not in ('n', 'p') or len(values) != len(columns):
+            return True, None
+        values = [datetime.fromisoformat(v)
+                  if isinstance(column.type, sa.DateTime) else v
+                  for column, v in zip(columns, values)]
+    except (ValueError, TypeError):
+        return True, None
+    return direction == 'n', values
+
+
+def _key_condition(columns, values, forward):
+    # (c1, c2) < (v1, v2) expanded so that it can use the column indexes
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value if forward else column > value
+    rest = _key_condition(columns[1:], values[1:], forward)
+    return sa.or_(column < value if forward else column > value,
+                  sa.and_(column == value, rest))
+
+
+def make_page(rows, columns, forward, values, per_page):
+    """
+    Build a page from rows fetched with one extra row past the page.
+
+    Args:
+        rows (list): The rows, in fetch order.
+        columns (tuple): The key columns of the query.
+        forward (bool): Whether the rows were fetched forward.
+        values (list): The key values of the cursor, or None.
+        per_page (int): The number of items per page.
+
+    Returns:
+        CursorPagination: The page.
+    """
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if forward:
+        has_next, has_prev = more, values is not None
+    else:
+        rows.reverse()
+        has_next, has_prev = True, more
+    next_cursor = prev_cursor = None
+    if rows:
+        keys = [column.key for column in columns]
+        if has_next:
+            next_cursor = encode_cursor(
+                [getattr(rows[-1], key) for key in keys], forward=True)
+        if has_prev:
+            prev_cursor = encode_cursor(
+                [getattr(rows[0], key) for key in keys], forward=False)
+    return CursorPagination(rows, has_next and next_cursor is not None,
+                            has_prev and prev_cursor is not None,
+                            next_cursor, prev_cursor)
+
+
+def paginate(query, columns, cursor=None, per_page=20):
+    """
+    Paginate a query with a keyset instead of an offset. Items are returned
+    in descending key order, and no count query is issued.
+
+    Args:
+        query (Select): The query to paginate.
+        columns (tuple): The key columns, which must be unique together.
+        cursor (str): The cursor of the requested page, or None for the
+            first page.
+        per_page (int): The number of items per page.
+
+    Returns:
+        CursorPagination: The requested page.
+    """
+    forward, values = decode_cursor(cursor, columns)
+    if values is not None:
+        query = query.where(_key_condition(columns, values, forward))
+    query = query.order_by(None).order_by(
+        *[column.desc() if forward else column.asc() for column in columns])
+    rows = db.session.scalars(query.limit(per_page + 1)).all()
+    return make_page(rows, columns, forward, values, per_page)
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+import redis
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+
+from app import db
+from app.models import User
+
+# Hash of user id -> last seen epoch seconds that were not written yet
+PENDING = 'last_seen:pending'
+# The pending hash while a flush writes it to the database
+FLUSHING = 'last_seen:flushing'
+# Set while a flush is scheduled, so at most one is scheduled per interval
+SCHEDULED = 'last_seen:scheduled'
+
+
+def _as_utc(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def record_seen(user):
+    """
+    Record that a user was seen now. The time is buffered in Redis, and the
+    first time buffered in an interval schedules a batch job that writes
+    the buffer to the database LAST_SEEN_FLUSH_INTERVAL seconds later, so
+    no time stays in the buffer for much longer than the interval. If Redis
+    is not available, the time is written directly, but only once the
+    stored time is older than the interval.
+
+    Args:
+        user (User): The user that was seen.
+    """
+    now = datetime.now(timezone.utc)
+    interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hset(PENDING, str(user.id), now.timestamp())
+        pipe.set(SCHEDULED, 1, nx=True, ex=interval)
+        _, schedule = pipe.execute()
+        if schedule:
+            current_app.task_queue.enqueue_in(timedelta(seconds=interval),
+                                              'app.tasks.flush_last_seen')
+        return
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Last seen buffer error: {e}')
+    if user.last_seen is None or \
+            (now - _as_utc(user.last_seen)).total_seconds() > interval:
+        user.last_seen = now
+        db.session.commit()
+
+
+def load_last_seen(user):
+    """
+    Replace the last seen time of a user with the buffered one, if there is
+    one that was not written to the database yet. The user is not marked as
+    changed.
+
+    Args:
+        user (User): The user.
+    """
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hget(PENDING, str(user.id))
+        pipe.hget(FLUSHING, str(user.id))
+        values = [float(value) for value in pipe.execute() if value]
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Last seen buffer error: {e}')
+        return
+    if values:
+        last_seen = datetime.fromtimestamp(max(values), timezone.utc)
+        if user.last_seen is None or last_seen > _as_utc(user.last_seen):
+            so.attributes.set_committed_value(user, 'last_seen', last_seen)
+
+
+def flush_last_seen():
+    """
+    Write the buffered last seen times to the database in one bulk UPDATE.
+    A time never replaces a more recent one.
+
+    Returns:
+        int: The number of buffered times that were written.
+    """
+    r = current_app.redis
+    try:
+        if not r.exists(FLUSHING):
+            # a flush that was interrupted is retried first
+            try:
+                r.rename(PENDING, FLUSHING)
+            except redis.exceptions.ResponseError:
+                # there is nothing to flush
+                return 0
+        pending = r.hgetall(FLUSHING)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Last seen flush error: {e}')
+        return 0
+    rows = [{'user_id': int(user_id),
+             'seen': datetime.fromtimestamp(float(seen), timezone.utc)}
+            for user_id, seen in pending.items()]
+    if rows:
+        db.session.connection().execute(
+            sa.update(User.__table__)
+            .where(User.__table__.c.id == sa.bindparam('user_id'),
+                   sa.or_(User.__table__.c.last_seen.is_(None),
+                          User.__table__.c.last_seen < sa.bindparam('seen')))
+            .values(last_seen=sa.bindparam('seen')), rows)
+        db.session.commit()
+    try:
+        r.delete(FLUSHING)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Last seen flush error: {e}')
+    return len(rows)
@@ -0,0 +1,157 @@
+from datetime import datetime, timezone
+import json
+import redis
+from flask import current_app
+
+from app import db
+from app.search.database import SQLiteBackend, PostgresBackend
+
+DATABASE_BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgresBackend
+}
+
+
+def get_backend():
+    """
+    Return the search backend of the application. Elasticsearch is used when
+    it is configured, and the database otherwise, if it supports full-text
+    search. The SEARCH_BACKEND setting forces one of them, or disables
+    search when set to 'none'.
+
+    Returns:
+        SearchBackend: The search backend, or None if search is disabled.
+    """
+    choice = current_app.config['SEARCH_BACKEND']
+    if choice == 'none':
+        return None
+    if current_app.elasticsearch and choice != 'database':
+        from app.search.elastic import ElasticsearchBackend
+        return ElasticsearchBackend(current_app.elasticsearch)
+    if choice == 'elasticsearch':
+        return None
+    backend = DATABASE_BACKENDS.get(db.engine.dialect.name)
+    return backend() if backend else None
+
+
+def ensure_index(model):
+    """
+    Create the search index of a model, if it does not exist yet.
+
+    Args:
+        model (Model): The searchable model.
+
+    Returns:
+        str: The name of the storage of the index.
+    """
+    return get_backend().ensure_index(model)
+
+
+def rebuild_index(model, chunk_size=1000, workers=1, keep_old=False,
+                  progress=None):
+    """
+    Rebuild the search index of a model from the database, without taking
+    search offline.
+
+    Args:
+        model (Model): The searchable model.
+        chunk_size (int): The number of records indexed per bulk request.
+        workers (int): The number of worker processes.
+        keep_old (bool): Whether to keep the storage that was replaced.
+        progress (callable): Passed to the model's reindex method.
+
+    Returns:
+        str: The name of the storage of the rebuilt index.
+    """
+    return get_backend().rebuild_index(
+        model, chunk_size=chunk_size, workers=workers, keep_old=keep_old,
+        progress=progress)
+
+
+def add_to_index(index, model):
+    """
+    Add a model instance to the search index.
+
+    Args:
+        index (str): The name of the index.
+        model (Model): The model instance to index.
+    """
+    bulk_update_index([(index, 'index', model.id, model.search_document())])
+
+
+def remove_from_index(index, model):
+    """
+    Remove a model instance from the search index.
+
+    Args:
+        index (str): The name of the index.
+        model (Model): The model instance to remove.
+    """
+    bulk_update_index([(index, 'delete', model.id, None)])
+
+
+def bulk_update_index(actions):
+    """
+    Apply index and delete actions to the search index in bulk.
+
+    Args:
+        actions (list): A list of (index, op, id, document) tuples, where op
+            is 'index' or 'delete' and document is None for deletes.
+
+    Returns:
+        list: A list of (index, op, id, error) tuples for the actions that
+            failed.
+    """
+    backend = get_backend()
+    if backend is None or not actions:
+        return []
+    return backend.bulk_update(actions)
+
+
+def record_dead_letters(failed):
+    """
+    Record index actions that could not be applied, so that they can be
+    inspected and replayed.
+
+    Args:
+        failed (list): A list of (index, op, id, error) tuples.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    entries = [json.dumps({'index': index, 'op': op, 'id': id,
+                           'error': error, 'timestamp': now})
+               for index, op, id, error in failed]
+    current_app.logger.error(
+        f"Search indexing failed for {len(entries)} documents")
+    try:
+        if entries:
+            current_app.redis.rpush('search:dead-letter', *entries)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.error(f"Dead letter error: {e}")
+
+
+def query_index(index, query, page, per_page, fields=None, source=False):
+    """
+    Query the search index.
+
+    Args:
+        index (str): The name of the index.
+        query (str): The search query.
+        page (int): The page number.
+        per_page (int): The number of results per page.
+        fields (list): The fields to match the query against, or None for
+            all of them. The database backends always match all the
+            searchable fields.
+        source (bool): Whether to return the stored documents, with the
+            matches in the query fields highlighted, instead of the IDs.
+
+    Returns:
+        tuple: A tuple containing the list of IDs, or of hits if source is
+            set, and the total count of results. Each hit is a dict with the
+            id, the source document and the highlighted fields, which are
+            HTML escaped and mark the matches with <mark> tags.
+    """
+    backend = get_backend()
+    if backend is None:
+        return [], 0
+    return backend.query(index, query, page, per_page, fields=fields,
+                         source=source)
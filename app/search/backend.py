@@ -0,0 +1,84 @@
+from markupsafe import escape
+
+# Highlight markers for backends that cannot escape the text around them.
+# They are private use characters, which ordinary text does not contain.
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_END = '\ue001'
+
+
+def highlight_markup(text):
+    """
+    Convert text with highlight markers to HTML, escaping the text and
+    marking the highlighted parts with <mark> tags.
+
+    Args:
+        text (str): The text with highlight markers.
+
+    Returns:
+        str: The HTML escaped text.
+    """
+    return str(escape(text)).replace(HIGHLIGHT_START, '<mark>').replace(
+        HIGHLIGHT_END, '</mark>')
+
+
+class UnmanagedIndexError(Exception):
+    pass
+
+
+class SearchBackend:
+    """
+    Base class of the search backends. Indexes are named after the table of
+    the model they index.
+    """
+    #: Whether changes are written in the transaction of the database
+    #: session that made them, instead of through the index outbox.
+    inline = False
+
+    def ensure_index(self, model):
+        """
+        Create the search index of a model, if it does not exist yet.
+
+        Args:
+            model (Model): The searchable model.
+
+        Returns:
+            str: The name of the storage of the index.
+        """
+        raise NotImplementedError
+
+    def rebuild_index(self, model, chunk_size=1000, workers=1, keep_old=False,
+                      progress=None):
+        """
+        Rebuild the search index of a model from the database.
+
+        Args:
+            model (Model): The searchable model.
+            chunk_size (int): The number of records indexed per bulk request.
+            workers (int): The number of worker processes.
+            keep_old (bool): Whether to keep the storage that was replaced.
+            progress (callable): Passed to the model's reindex method.
+
+        Returns:
+            str: The name of the storage of the rebuilt index.
+        """
+        raise NotImplementedError
+
+    def bulk_update(self, actions):
+        """
+        Apply index and delete actions in bulk.
+
+        Args:
+            actions (list): A list of (index, op, id, document) tuples, where
+                op is 'index' or 'delete' and document is None for deletes.
+
+        Returns:
+            list: A list of (index, op, id, error) tuples for the actions
+                that failed.
+        """
+        raise NotImplementedError
+
+    def query(self, index, query, page, per_page, fields=None, source=False):
+        """
+        Query a search index. See app.search.query_index().
+        """
+        raise NotImplementedError
@@ -0,0 +1,312 @@
+import json
+import weakref
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.search.backend import SearchBackend, HIGHLIGHT_START, \
+    HIGHLIGHT_END, highlight_markup
+
+# The index tables that are known to exist, by engine
+_tables = weakref.WeakKeyDictionary()
+
+
+def _model(index):
+    for mapper in db.Model.registry.mappers:
+        if getattr(mapper.class_, '__tablename__', None) == index:
+            return mapper.class_
+    raise KeyError(index)
+
+
+def _searchable_fields(index):
+    return _model(index).__searchable__
+
+
+class DatabaseBackend(SearchBackend):
+    """
+    Base class of the search backends that keep the indexes in tables of
+    the application database. Each index is a table named search_<index>,
+    with a copy of the searchable fields and of the search document of
+    every record. Changes are written in the same transaction as the
+    records themselves. The tables are created on first use, so that no
+    setup step is needed.
+    """
+    inline = True
+    #: The column that holds the primary key of the indexed record.
+    key = None
+
+    def table(self, index):
+        return f'search_{index}'
+
+    def create_table(self, connection, model):
+        """
+        Create the index table of a model, if it does not exist yet.
+
+        Args:
+            connection (Connection): The database connection.
+            model (Model): The searchable model.
+        """
+        raise NotImplementedError
+
+    def ensure_index(self, model):
+        table = self.table(model.__tablename__)
+        with db.engine.begin() as connection:
+            self.create_table(connection, model)
+        _tables.setdefault(db.engine, set()).add(table)
+        return table
+
+    def require_table(self, connection, index):
+        """
+        Create the table of an index in the transaction of a connection, if
+        it is not known to exist.
+
+        Args:
+            connection (Connection): The database connection.
+            index (str): The name of the index.
+
+        Returns:
+            str: The name of the index table.
+        """
+        table = self.table(index)
+        known = _tables.setdefault(connection.engine, set())
+        if table not in known:
+            self.create_table(connection, _model(index))
+            known.add(table)
+        return table
+
+    def forget_tables(self, engine):
+        # a table created in a transaction that was rolled back is gone
+        _tables.pop(engine, None)
+
+    def write(self, connection, table, fields, rows):
+        """
+        Insert or replace rows in an index table.
+
+        Args:
+            connection (Connection): The database connection.
+            table (str): The name of the index table.
+            fields (list): The searchable fields of the index.
+            rows (list): A list of dicts with the primary key under 'id',
+                the searchable fields and the search document as JSON under
+                'document'.
+        """
+        raise NotImplementedError
+
+    def update(self, connection, actions):
+        """
+        Apply index and delete actions on the given connection.
+
+        Args:
+            connection (Connection): The database connection.
+            actions (list): A list of (index, op, id, document) tuples.
+        """
+        pending = {}
+        for index, op, id, document in actions:
+            pending.setdefault(index, {})[id] = document if op == 'index' \
+                else None
+        try:
+            for index, documents in pending.items():
+                self.update_index(connection, index, documents)
+        except sa.exc.SQLAlchemyError:
+            self.forget_tables(connection.engine)
+            raise
+
+    def update_index(self, connection, index, documents):
+        table = self.require_table(connection, index)
+        fields = _searchable_fields(index)
+        deleted = [id for id, document in documents.items()
+                   if document is None]
+        if deleted:
+            connection.execute(sa.text(
+                f'DELETE FROM {table} WHERE {self.key} IN :ids')
+                .bindparams(sa.bindparam('ids', expanding=True)),
+                {'ids': deleted})
+        rows = [{'id': id,
+                 'document': json.dumps(document, default=str),
+                 **{field: document.get(field) for field in fields}}
+                for id, document in documents.items()
+                if document is not None]
+        if rows:
+            self.write(connection, table, fields, rows)
+
+    def bulk_update(self, actions):
+        try:
+            with db.engine.begin() as connection:
+                self.update(connection, actions)
+        except sa.exc.SQLAlchemyError as e:
+            current_app.logger.error(f"Search index update error: {e}")
+            return [(index, op, id, str(e)) for index, op, id, _ in actions]
+        return []
+
+    def rebuild_index(self, model, chunk_size=1000, workers=1, keep_old=False,
+                      progress=None):
+        """
+        Rewrite the index of a model in place, then remove the rows of
+        records that no longer exist. Searches keep working while the index
+        is rewritten, since each chunk of rows is replaced in one
+        transaction.
+        """
+        table = self.ensure_index(model)
+        model.reindex(chunk_size=chunk_size, workers=workers, resume=False,
+                      progress=progress)
+        with db.engine.begin() as connection:
+            connection.execute(sa.text(
+                f'DELETE FROM {table} WHERE {self.key} NOT IN '
+                f'(SELECT id FROM {model.__tablename__})'))
+        return table
+
+    def run_query(self, index, statement, count, params, page, per_page,
+                  source):
+        """
+        Run a search query and its count query on the table of an index,
+        which is created first if it is not known to exist. An index whose
+        table cannot be created has no results.
+        """
+        table = self.table(index)
+        if table not in _tables.get(db.engine, ()):
+            try:
+                self.ensure_index(_model(index))
+            except sa.exc.SQLAlchemyError as e:
+                current_app.logger.warning(f'Search index error: {e}')
+                return [], 0
+        try:
+            total = db.session.scalar(sa.text(count), params)
+        except sa.exc.DBAPIError:
+            db.session.rollback()
+            if sa.inspect(db.engine).has_table(table):
+                raise
+            # it was created in a transaction that was rolled back
+            self.forget_tables(db.engine)
+            current_app.logger.warning(f'Search index {table} is missing')
+            return [], 0
+        if not total:
+            return [], 0
+        rows = db.session.execute(sa.text(statement), {
+            **params, 'limit': per_page, 'offset': (page - 1) * per_page})
+        if not source:
+            return [row.id for row in rows], total
+        hits = []
+        for row in rows:
+            document = row.document
+            if isinstance(document, str):
+                document = json.loads(document)
+            highlight = {field: highlight_markup(value)
+                         for field, value in row._mapping.items()
+                         if field not in ('id', 'document') and value}
+            hits.append({'id': row.id, 'source': document,
+                         'highlight': highlight})
+        return hits, total
+
+
+class SQLiteBackend(DatabaseBackend):
+    """
+    Search backend for SQLite databases, with FTS5 full-text tables ranked
+    by BM25.
+    """
+    key = 'rowid'
+
+    def create_table(self, connection, model):
+        table = self.table(model.__tablename__)
+        columns = ', '.join(model.__searchable__)
+        connection.execute(sa.text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5('
+            f'{columns}, document UNINDEXED, '
+            f"tokenize='unicode61 remove_diacritics 2')"))
+
+    def write(self, connection, table, fields, rows):
+        # FTS5 tables do not support upserts
+        connection.execute(sa.text(
+            f'DELETE FROM {table} WHERE rowid IN :ids').bindparams(
+                sa.bindparam('ids', expanding=True)),
+            {'ids': [row['id'] for row in rows]})
+        columns = ', '.join(fields)
+        values = ', '.join(f':{field}' for field in fields)
+        connection.execute(sa.text(
+            f'INSERT INTO {table} (rowid, {columns}, document) '
+            f'VALUES (:id, {values}, :document)'), rows)
+
+    def rebuild_index(self, model, chunk_size=1000, workers=1, keep_old=False,
+                      progress=None):
+        table = super().rebuild_index(model, chunk_size=chunk_size,
+                                      workers=workers, keep_old=keep_old,
+                                      progress=progress)
+        with db.engine.begin() as connection:
+            connection.execute(sa.text(
+                f"INSERT INTO {table} ({table}) VALUES ('optimize')"))
+        return table
+
+    def query(self, index, query, page, per_page, fields=None, source=False):
+        # every word is quoted, so that the query syntax is not exposed
+        terms = ['"{}"'.format(term.replace('"', '""'))
+                 for term in query.split()]
+        if not terms:
+            return [], 0
+        table = self.table(index)
+        columns = ['rowid AS id']
+        if source:
+            columns.append('document')
+            columns += [f"highlight({table}, {i}, :start, :end) AS {field}"
+                        for i, field in enumerate(_searchable_fields(index))]
+        where = f'{table} MATCH :query'
+        return self.run_query(
+            index, f'SELECT {", ".join(columns)} FROM {table} WHERE {where} '
+            f'ORDER BY rank LIMIT :limit OFFSET :offset',
+            f'SELECT count(*) FROM {table} WHERE {where}',
+            {'query': ' '.join(terms), 'start': HIGHLIGHT_START,
+             'end': HIGHLIGHT_END},
+            page, per_page, source)
+
+
+class PostgresBackend(DatabaseBackend):
+    """
+    Search backend for PostgreSQL databases, with tsvector columns indexed
+    with GIN and ranked by cover density.
+    """
+    key = 'object_id'
+    #: The text search configuration. The simple configuration does not
+    #: stem words, which suits posts written in any language.
+    config = 'simple'
+
+    def create_table(self, connection, model):
+        table = self.table(model.__tablename__)
+        columns = ''.join(f'{field} text, ' for field in model.__searchable__)
+        connection.execute(sa.text(
+            f'CREATE TABLE IF NOT EXISTS {table} ('
+            f'object_id integer PRIMARY KEY, {columns}'
+            f'document jsonb NOT NULL, vector tsvector NOT NULL)'))
+        connection.execute(sa.text(
+            f'CREATE INDEX IF NOT EXISTS ix_{table}_vector ON {table} '
+            f'USING gin (vector)'))
+
+    def write(self, connection, table, fields, rows):
+        columns = ''.join(f'{field}, ' for field in fields)
+        values = ''.join(f':{field}, ' for field in fields)
+        text = ', '.join(f':{field}' for field in fields)
+        updates = ''.join(f'{field} = excluded.{field}, ' for field in fields)
+        connection.execute(sa.text(
+            f'INSERT INTO {table} (object_id, {columns}document, vector) '
+            f'VALUES (:id, {values}CAST(:document AS jsonb), '
+            f"to_tsvector('{self.config}', concat_ws(' ', {text}))) "
+            f'ON CONFLICT (object_id) DO UPDATE SET {updates}'
+            f'document = excluded.document, vector = excluded.vector'), rows)
+
+    def query(self, index, query, page, per_page, fields=None, source=False):
+        table = self.table(index)
+        columns = ['object_id AS id']
+        if source:
+            options = f'StartSel={HIGHLIGHT_START}, ' \
+                f'StopSel={HIGHLIGHT_END}, HighlightAll=true'
+            columns.append('document')
+            columns += [f"ts_headline('{self.config}', {field}, q, "
+                        f"'{options}') AS {field}"
+                        for field in _searchable_fields(index)]
+        source_table = f"{table}, websearch_to_tsquery('{self.config}', " \
+            f":query) AS q"
+        return self.run_query(
+            index, f'SELECT {", ".join(columns)} FROM {source_table} '
+            f'WHERE vector @@ q '
+            f'ORDER BY ts_rank_cd(vector, q) DESC, object_id DESC '
+            f'LIMIT :limit OFFSET :offset',
+            f'SELECT count(*) FROM {source_table} WHERE vector @@ q',
+            {'query': query},
+            page, per_page, source)
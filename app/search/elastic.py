@@ -0,0 +1,226 @@
+from datetime import datetime, timezone
+from hashlib import sha1
+import json
+import redis
+import sqlalchemy as sa
+from elasticsearch import helpers
+from flask import current_app
+
+from app.search.backend import SearchBackend, UnmanagedIndexError
+
+
+def index_definition(model):
+    """
+    Build the settings and mappings of the search index of a model. Field
+    types come from the columns listed in the model's __searchable__
+    attribute, and text fields are analyzed with a case and accent folding
+    analyzer. Fields that are not mapped are kept in the source but not
+    indexed.
+
+    Args:
+        model (Model): The searchable model.
+
+    Returns:
+        dict: The settings and mappings of the index.
+    """
+    properties = {}
+    for field in model.__searchable__:
+        column_type = model.__table__.columns[field].type
+        if isinstance(column_type, (sa.String, sa.Text)):
+            properties[field] = {'type': 'text', 'analyzer': 'folding'}
+        elif isinstance(column_type, sa.DateTime):
+            properties[field] = {'type': 'date'}
+        elif isinstance(column_type, sa.Boolean):
+            properties[field] = {'type': 'boolean'}
+        elif isinstance(column_type, sa.Integer):
+            properties[field] = {'type': 'long'}
+        else:
+            properties[field] = {'type': 'keyword'}
+    properties.update(getattr(model, '__search_mapping__', {}))
+    return {
+        'settings': {
+            'number_of_shards': 1,
+            'number_of_replicas': current_app.config['ELASTICSEARCH_REPLICAS'],
+            'refresh_interval': current_app.config[
+                'ELASTICSEARCH_REFRESH_INTERVAL'],
+            'analysis': {
+                'analyzer': {
+                    'folding': {
+                        'tokenizer': 'standard',
+                        'filter': ['lowercase', 'asciifolding']
+                    }
+                }
+            }
+        },
+        'mappings': {
+            'dynamic': False,
+            'properties': properties
+        }
+    }
+
+
+def index_version(model):
+    """
+    Return the version of the index definition of a model, a short hash
+    that changes whenever the definition changes.
+
+    Args:
+        model (Model): The searchable model.
+
+    Returns:
+        str: The version of the index definition.
+    """
+    definition = json.dumps(index_definition(model), sort_keys=True)
+    return sha1(definition.encode('utf-8')).hexdigest()[:8]
+
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Search backend that stores the indexes in an Elasticsearch cluster.
+    Each index is addressed through an alias named after the model.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def ensure_index(self, model):
+        """
+        Create the search index of a model and its alias, if they do not
+        exist yet. An index from before aliases were used is left alone,
+        since replacing it with an empty one would drop its documents, and
+        only a rebuild can move it behind the alias.
+
+        Raises:
+            UnmanagedIndexError: If an index that is not behind an alias has
+                the name of the alias.
+        """
+        es = self.client
+        alias = model.__tablename__
+        if es.indices.exists_alias(name=alias):
+            return next(iter(es.indices.get_alias(name=alias)))
+        if es.indices.exists(index=alias):
+            raise UnmanagedIndexError(
+                f'The {alias} index is not behind an alias. Run "flask '
+                f'search rebuild" to reindex it into a versioned index.')
+        index = f'{alias}-{index_version(model)}'
+        if not es.indices.exists(index=index):
+            es.indices.create(index=index, **index_definition(model))
+        es.indices.update_aliases(
+            actions=[{'add': {'index': index, 'alias': alias}}])
+        return index
+
+    def rebuild_index(self, model, chunk_size=1000, workers=1, keep_old=False,
+                      progress=None):
+        """
+        Build a new version of the search index of a model and switch its
+        alias over to it in one atomic step, so searches are never served
+        from a partial index. Refresh and replicas are disabled while the
+        index is loaded, and changes applied while it is being built are
+        written to both indexes.
+        """
+        es = self.client
+        alias = model.__tablename__
+        definition = index_definition(model)
+        index = '{}-{}-{}'.format(
+            alias, index_version(model),
+            datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S'))
+        settings = definition['settings']
+        es.indices.create(index=index, mappings=definition['mappings'],
+                          settings={**settings, 'refresh_interval': '-1',
+                                    'number_of_replicas': 0})
+        building = f'search:building:{alias}'
+        current_app.redis.set(building, index)
+        try:
+            model.reindex(chunk_size=chunk_size, workers=workers,
+                          resume=False, index=index, progress=progress)
+            es.indices.put_settings(index=index, settings={
+                'refresh_interval': settings['refresh_interval'],
+                'number_of_replicas': settings['number_of_replicas']})
+            es.indices.refresh(index=index)
+            old = list(es.indices.get_alias(name=alias)) \
+                if es.indices.exists_alias(name=alias) else []
+            actions = [{'remove': {'index': name, 'alias': alias}}
+                       for name in old]
+            if es.indices.exists(index=alias) and \
+                    not es.indices.exists_alias(name=alias):
+                actions.append({'remove_index': {'index': alias}})
+            actions.append({'add': {'index': index, 'alias': alias}})
+            es.indices.update_aliases(actions=actions)
+        except Exception:
+            es.indices.delete(index=index, ignore_unavailable=True)
+            raise
+        finally:
+            current_app.redis.delete(building)
+        if not keep_old:
+            for name in old:
+                es.indices.delete(index=name, ignore_unavailable=True)
+        return index
+
+    def bulk_update(self, actions):
+        building = {}
+        try:
+            for index in {action[0] for action in actions}:
+                name = current_app.redis.get(f'search:building:{index}')
+                if name:
+                    building[index] = name.decode('utf-8')
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f"Search index lookup error: {e}")
+        operations = []
+        sources = []
+        for index, op, id, document in actions:
+            for name in (index, building.get(index)):
+                if name is None:
+                    continue
+                operation = {'_op_type': op, '_index': name, '_id': id}
+                if op == 'index':
+                    operation['_source'] = document
+                operations.append(operation)
+                sources.append((index, op, id))
+        failed = []
+        try:
+            # results come back in the order of the operations
+            for (index, op, id), (ok, item) in zip(
+                    sources, helpers.streaming_bulk(
+                        self.client, operations, raise_on_error=False,
+                        raise_on_exception=False)):
+                result = item[op]
+                # deleting a document that is not in the index is not an
+                # error
+                if not ok and not (op == 'delete' and
+                                   result.get('status') == 404):
+                    failed.append((index, op, id, str(result.get('error'))))
+        except Exception as e:
+            current_app.logger.error(f"Elasticsearch bulk error: {e}")
+            return [(index, op, id, str(e)) for index, op, id, _ in actions]
+        return failed
+
+    def query(self, index, query, page, per_page, fields=None, source=False):
+        fields = fields or ['*']
+        options = {'source': False}
+        if source:
+            options = {
+                'source': True,
+                'highlight': {
+                    'encoder': 'html',
+                    'pre_tags': ['<mark>'],
+                    'post_tags': ['</mark>'],
+                    # whole fields rather than fragments
+                    'fields': {field: {'number_of_fragments': 0}
+                               for field in fields}
+                }
+            }
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': fields}},
+            from_=(page - 1) * per_page,
+            size=per_page,
+            **options
+        )
+        hits = search['hits']['hits']
+        total = search['hits']['total']['value']
+        if not source:
+            return [int(hit['_id']) for hit in hits], total
+        return [{'id': int(hit['_id']),
+                 'source': hit['_source'],
+                 'highlight': {field: fragments[0] for field, fragments
+                               in hit.get('highlight', {}).items()}}
+                for hit in hits], total
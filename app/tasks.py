@@ -1,41 +1,60 @@
-import json
 import sys
-import time
 import sqlalchemy as sa
 from flask import render_template
 from rq import get_current_job
 
-from app import create_app, db
-from app.models import User, Post, Task
+from app import create_app, db, email, exports, language, presence, \
+    timeline
+from app.models import User, Post, Task, IndexOutbox, Notification
 # from app.email import send_email
 
 app = create_app()
 app.app_context().push()
 
 
-def _set_task_progress(progress):
+def _set_task_progress(progress, failed=False):
     """
-    Set the progress of the current task.
+    Set the progress of the current task. The task is complete when it
+    reaches 100 percent, or when it failed.
 
     Args:
         progress (int): The progress percentage to set.
+        failed (bool): Whether the task failed.
     """
     job = get_current_job()
     if job:
+        complete = failed or progress >= 100
         job.meta['progress'] = progress
+        if failed:
+            job.meta['failed'] = True
         job.save_meta()
         task = db.session.get(Task, job.get_id())
-        task.user.add_notification(
-                'task_progress', {'task_id': job.get_id(
-                    ), 'progress': progress})
-        if progress >= 100:
+        Task.record_progress(task.user_id, task.id, progress,
+                             complete=complete)
+        data = {'task_id': job.get_id(), 'progress': progress}
+        if failed:
+            data['failed'] = True
+        task.user.add_notification('task_progress', data, force=complete)
+        if complete:
             task.complete = True
         db.session.commit()
 
 
+def _fail_task():
+    """
+    Mark the current task as failed, at the progress it had reached.
+    """
+    # the session cannot be used after a failed statement
+    db.session.rollback()
+    job = get_current_job()
+    if job:
+        _set_task_progress(job.meta.get('progress', 0), failed=True)
+
+
 def export_posts(user_id):
     """
-    Export the posts of a user to a JSON file and send it via email.
+    Export the posts of a user to a compressed NDJSON file that the user
+    can download.
 
     Args:
         user_id (int): The ID of the user whose posts are to be exported.
@@ -43,17 +62,11 @@ def export_posts(user_id):
     try:
         user = db.session.get(User, user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(sa.select(
-            sa.func.count()).select_from(user.posts.select().subquery()))
-        for post in db.session.scalars(
-                user.posts.select().order_by(Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(1)
-            _set_task_progress(100 * i // total_posts)
-            i += 1
+        exports.export_posts(
+            user, exports.export_path(app.config['EXPORT_DIR'], user),
+            batch_size=app.config['EXPORT_BATCH_SIZE'],
+            progress=_set_task_progress,
+            progress_interval=app.config['EXPORT_PROGRESS_INTERVAL'])
 
         # send_email(
         #     '[Genblog] Your blog posts',
@@ -61,12 +74,90 @@ def export_posts(user_id):
         #     recipients=[user.email],
         #     text_body=render_template('email/export_posts.txt', user=user),
         #     html_body=render_template('email/export_posts.html', user=user),
-        #     attachments=[('posts.json', 'application/json', json.dumps({
-        #           'posts': data}, indent=4))],
         #     sync=True
         # )
     except Exception:
-        _set_task_progress(100)
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
-    finally:
+        _fail_task()
+    else:
         _set_task_progress(100)
+
+
+def fan_out_post(post_id):
+    """
+    Push a new post to the home timelines of its author's followers.
+
+    Args:
+        post_id (int): The ID of the new post.
+    """
+    post = db.session.get(Post, post_id)
+    if post is not None:
+        timeline.fan_out(post)
+
+
+def rebuild_timeline(user_id):
+    """
+    Rebuild the home timeline of a user from the database.
+
+    Args:
+        user_id (int): The ID of the user whose timeline is rebuilt.
+    """
+    user = db.session.get(User, user_id)
+    if user is not None:
+        timeline.rebuild(user)
+
+
+def drain_index_outbox():
+    """
+    Apply the pending changes in the search index outbox.
+    """
+    IndexOutbox.drain()
+
+
+def flush_last_seen():
+    """
+    Write the buffered last seen times of users to the database.
+    """
+    presence.flush_last_seen()
+
+
+def flush_notification(user_id, name):
+    """
+    Write the latest held back notification of a user to the database.
+
+    Args:
+        user_id (int): The ID of the user.
+        name (str): The name of the notification.
+    """
+    Notification.flush(user_id, name)
+
+
+def detect_post_languages(post_ids):
+    """
+    Detect and store the language of new posts.
+
+    Args:
+        post_ids (list): The IDs of the posts.
+    """
+    posts = db.session.scalars(sa.select(Post).where(Post.id.in_(post_ids)))
+    language.detect_post_languages(posts)
+    db.session.commit()
+
+
+def send_emails(messages):
+    """
+    Send a batch of email messages over the worker's SMTP connection. The
+    number of messages handled is saved with the job, so that a retry after
+    a transient failure resumes after the last message that was handled.
+
+    Args:
+        messages (list): The fields of each message.
+    """
+    job = get_current_job()
+
+    def progress(handled):
+        job.meta['sent'] = handled
+        job.save_meta()
+
+    email.deliver_batch(messages, sent=job.meta.get('sent', 0),
+                        progress=progress)
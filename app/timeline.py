@@ -0,0 +1,257 @@
+from datetime import timezone
+import redis
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import Post, followers
+from app.pagination import decode_cursor, make_page
+
+# Marks a timeline that holds the complete history of the feed. Trimming
+# drops it first, since it always carries the lowest score.
+SENTINEL = '-'
+
+
+def _key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _score(timestamp):
+    """
+    Return the sorted set score of a post timestamp, in epoch seconds.
+
+    Args:
+        timestamp (datetime): The timestamp of the post.
+
+    Returns:
+        float: The score of the post.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def _trim(pipe, key):
+    pipe.zremrangebyrank(key, 0, -(current_app.config['TIMELINE_LENGTH'] + 1))
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+
+
+def get_page(user, cursor, per_page):
+    """
+    Read one page of a user's home timeline from its materialized copy.
+
+    Args:
+        user (User): The user whose timeline is read.
+        cursor (str): The cursor of the requested page, or None for the
+            first page.
+        per_page (int): The number of posts per page.
+
+    Returns:
+        CursorPagination: The requested page, or None if the page cannot
+            be served from the cache.
+    """
+    columns = (Post.timestamp, Post.id)
+    forward, values = decode_cursor(cursor, columns)
+    key = _key(user.id)
+    try:
+        pipe = current_app.redis.pipeline()
+        if values is None:
+            pipe.zrevrangebyscore(key, '+inf', '-inf', start=0,
+                                  num=per_page + 1, withscores=True)
+        else:
+            # posts tied on the cursor score are ordered by id below
+            score = _score(values[0])
+            pipe.zrangebyscore(key, score, score, withscores=True)
+            if forward:
+                pipe.zrevrangebyscore(key, f'({score}', '-inf', start=0,
+                                      num=per_page + 1, withscores=True)
+            else:
+                pipe.zrangebyscore(key, f'({score}', '+inf', start=0,
+                                   num=per_page + 1, withscores=True)
+                pipe.zrange(key, 0, 0, withscores=True)
+        results = pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline read error: {e}')
+        return None
+    if not forward:
+        # the posts newer than the cursor are all cached only if the cursor
+        # is newer than the oldest cached post, or the feed is complete
+        oldest = results.pop()
+        if not oldest or (oldest[0][0].decode('utf-8') != SENTINEL and
+                          oldest[0][1] >= _score(values[0])):
+            return None
+    complete = False
+    entries = []
+    for member, score in [entry for result in results for entry in result]:
+        member = member.decode('utf-8')
+        if member == SENTINEL:
+            complete = True
+        else:
+            entries.append((score, int(member)))
+    if values is not None:
+        score = _score(values[0])
+        entries = [entry for entry in entries if entry[0] != score or (
+            entry[1] < values[1] if forward else entry[1] > values[1])]
+    entries.sort(reverse=forward)
+    entries = entries[:per_page + 1]
+    if forward and not complete and len(entries) <= per_page:
+        # the page extends past what the cache holds, or there is no cache
+        return None
+    ids = [id for _, id in entries]
+    posts = {post.id: post for post in db.session.scalars(
+        sa.select(Post).where(Post.id.in_(ids)))}
+    return make_page([posts[id] for id in ids if id in posts], columns,
+                     forward, values, per_page)
+
+
+def rebuild(user):
+    """
+    Rebuild a user's home timeline from the database.
+
+    Args:
+        user (User): The user whose timeline is rebuilt.
+    """
+    length = current_app.config['TIMELINE_LENGTH']
+    posts = db.session.scalars(user.following_posts().limit(length)).all()
+    entries = {str(post.id): _score(post.timestamp) for post in posts}
+    if len(posts) < length:
+        entries[SENTINEL] = float('-inf')
+    key = _key(user.id)
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, entries)
+        _trim(pipe, key)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline rebuild error: {e}')
+
+
+def fan_out(post, batch_size=500):
+    """
+    Push a new post to the timelines of its author and the author's
+    followers. Only timelines that are already materialized are updated,
+    the others are built on their next read.
+
+    Args:
+        post (Post): The new post.
+        batch_size (int): The number of timelines updated per round trip.
+    """
+    query = sa.select(followers.c.follower_id).where(
+        followers.c.followed_id == post.user_id)
+    user_ids = [post.user_id]
+    try:
+        for follower_id in db.session.scalars(
+                query.execution_options(yield_per=batch_size)):
+            user_ids.append(follower_id)
+            if len(user_ids) >= batch_size:
+                _push(post, user_ids)
+                user_ids = []
+        if user_ids:
+            _push(post, user_ids)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline fan-out error: {e}')
+
+
+def _push(post, user_ids):
+    pipe = current_app.redis.pipeline()
+    for user_id in user_ids:
+        pipe.exists(_key(user_id))
+    exists = pipe.execute()
+    pipe = current_app.redis.pipeline()
+    for user_id, found in zip(user_ids, exists):
+        if found:
+            key = _key(user_id)
+            pipe.zadd(key, {str(post.id): _score(post.timestamp)})
+            _trim(pipe, key)
+    pipe.execute()
+
+
+def schedule_fan_out(post):
+    """
+    Add a new post to its author's timeline right away and queue the
+    fan-out to the followers.
+
+    Args:
+        post (Post): The new post.
+    """
+    try:
+        key = _key(post.user_id)
+        if current_app.redis.exists(key):
+            pipe = current_app.redis.pipeline()
+            pipe.zadd(key, {str(post.id): _score(post.timestamp)})
+            _trim(pipe, key)
+            pipe.execute()
+        current_app.task_queue.enqueue('app.tasks.fan_out_post', post.id)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline fan-out error: {e}')
+
+
+def schedule_rebuild(user):
+    """
+    Queue a rebuild of a user's home timeline.
+
+    Args:
+        user (User): The user whose timeline is rebuilt.
+    """
+    try:
+        current_app.task_queue.enqueue('app.tasks.rebuild_timeline', user.id)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline rebuild error: {e}')
+
+
+def add_author(user, author):
+    """
+    Backfill a user's timeline with the recent posts of a followed author.
+    A timeline that does not hold the complete feed only gets the posts that
+    are newer than its oldest one, since the older posts of the other
+    authors are not in it.
+
+    Args:
+        user (User): The follower.
+        author (User): The user that was followed.
+    """
+    length = current_app.config['TIMELINE_LENGTH']
+    posts = db.session.scalars(author.posts.select().order_by(
+        Post.timestamp.desc()).limit(length)).all()
+    if not posts:
+        return
+    key = _key(user.id)
+    try:
+        oldest = current_app.redis.zrange(key, 0, 0, withscores=True)
+        if not oldest:
+            return
+        member, lowest = oldest[0]
+        if member.decode('utf-8') != SENTINEL:
+            posts = [post for post in posts
+                     if _score(post.timestamp) > lowest]
+            if not posts:
+                return
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(key, {str(post.id): _score(post.timestamp) for post in posts})
+        _trim(pipe, key)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline backfill error: {e}')
+
+
+def remove_author(user, author):
+    """
+    Remove the posts of an unfollowed author from a user's timeline. Only
+    the author's most recent posts can be in a trimmed timeline, so only
+    those are removed.
+
+    Args:
+        user (User): The follower.
+        author (User): The user that was unfollowed.
+    """
+    length = current_app.config['TIMELINE_LENGTH']
+    ids = db.session.scalars(sa.select(Post.id).where(
+        Post.user_id == author.id).order_by(
+            Post.timestamp.desc()).limit(length)).all()
+    if not ids:
+        return
+    try:
+        current_app.redis.zrem(_key(user.id), *[str(id) for id in ids])
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Timeline repair error: {e}')
@@ -1,37 +1,222 @@
-import requests
+from collections import OrderedDict
+from hashlib import sha1
+import json
+from threading import Lock
+from time import monotonic
+import redis
 from flask import current_app
 from flask_babel import _
 
+# The Microsoft Translator limits the number of texts per request
+MAX_BATCH_SIZE = 100
 
-def translate(text, source_language, dest_language):
+
+class TranslationError(Exception):
+    pass
+
+
+class LocalCache:
+    """
+    A thread safe in-process LRU cache with expiring entries.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MicrosoftTranslator:
+    """
+    Client of the Microsoft Translator API, with a pooled HTTP session that
+    is reused across requests.
+    """
+    url = 'https://api.cognitive.microsofttranslator.com/translate'
+
+    def __init__(self, key, region, timeout):
+        # imported here, only this translator needs them
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import Retry
+        self.key = key
+        self.region = region
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=2, backoff_factor=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['POST'])
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=10,
+                                                   max_retries=retry))
+
+    def translate(self, texts, source_language, dest_language):
+        import requests
+        try:
+            r = self.session.post(
+                self.url,
+                params={'api-version': '3.0', 'from': source_language,
+                        'to': dest_language},
+                headers={'Ocp-Apim-Subscription-Key': self.key,
+                         'Ocp-Apim-Subscription-Region': self.region},
+                json=[{'Text': text} for text in texts],
+                timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise TranslationError(str(e))
+        if r.status_code != 200:
+            raise TranslationError(f'status {r.status_code}')
+        return [result['translations'][0]['text'] for result in r.json()]
+
+
+class StubTranslator:
+    """
+    Translator that tags texts with the destination language instead of
+    translating them, for tests and development.
+    """
+    def translate(self, texts, source_language, dest_language):
+        return [f'[{dest_language}] {text}' for text in texts]
+
+
+_translators = {}
+_local_cache = None
+
+
+def get_translator():
     """
-    Translate text from one language to another using Microsoft Translator.
+    Return the translator selected by the TRANSLATOR setting, or None if
+    translation is not configured. Translators are created once per process,
+    so that their HTTP connections are reused.
+    """
+    config = current_app.config
+    name = config['TRANSLATOR'] or ('microsoft' if config['MS_TRANSLATOR_KEY']
+                                    else None)
+    if name is None or (name == 'microsoft' and
+                        not config['MS_TRANSLATOR_KEY']):
+        return None
+    key = (name, config['MS_TRANSLATOR_KEY'])
+    if key not in _translators:
+        if name == 'stub':
+            _translators[key] = StubTranslator()
+        else:
+            _translators[key] = MicrosoftTranslator(
+                config['MS_TRANSLATOR_KEY'], config['MS_TRANSLATOR_REGION'],
+                config['TRANSLATOR_TIMEOUT'])
+    return _translators[key]
+
+
+def _get_local_cache():
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LocalCache(current_app.config['TRANSLATION_CACHE_SIZE'],
+                                  current_app.config['TRANSLATION_CACHE_TTL'])
+    return _local_cache
+
+
+def _cache_key(text, source_language, dest_language):
+    digest = sha1(text.encode('utf-8')).hexdigest()
+    return f'translation:{source_language}:{dest_language}:{digest}'
+
+
+def translate_batch(texts, source_language, dest_language):
+    """
+    Translate texts from one language to another. Translations are cached
+    in process and in Redis, and the texts that are not cached are sent to
+    the translator in as few requests as possible.
 
     Args:
-        text (str): The text to translate.
+        texts (list): The texts to translate.
         source_language (str): The source language code.
         dest_language (str): The destination language code.
 
     Returns:
-        str: The translated text or an error message if the translation fails.
+        list: The translated texts, in the order of the given texts.
+
+    Raises:
+        TranslationError: If translation is not configured or fails.
     """
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or not\
-            current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
+    translator = get_translator()
+    if translator is None:
+        raise TranslationError('not configured')
+    local = _get_local_cache()
+    keys = [_cache_key(text, source_language, dest_language)
+            for text in texts]
+    results = [local.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        try:
+            cached = current_app.redis.mget([keys[i] for i in missing])
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f'Translation cache error: {e}')
+            cached = [None] * len(missing)
+        for i, value in zip(missing, cached):
+            if value is not None:
+                results[i] = json.loads(value)
+                local.set(keys[i], results[i])
+    # identical texts are translated once
+    pending = {}
+    for i, result in enumerate(results):
+        if result is None:
+            pending.setdefault(texts[i], []).append(i)
+    if not pending:
+        return results
+    pending_texts = list(pending)
+    translations = []
+    for start in range(0, len(pending_texts), MAX_BATCH_SIZE):
+        translations += translator.translate(
+            pending_texts[start:start + MAX_BATCH_SIZE], source_language,
+            dest_language)
+    for text, translation in zip(pending_texts, translations):
+        local.set(keys[pending[text][0]], translation)
+        for i in pending[text]:
+            results[i] = translation
+    ttl = current_app.config['TRANSLATION_CACHE_TTL']
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for text, translation in zip(pending_texts, translations):
+            pipe.set(keys[pending[text][0]], json.dumps(translation), ex=ttl)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Translation cache error: {e}')
+    return results
 
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus'
-    }
 
-    url = (
-        'https://api.cognitive.microsofttranslator.com/translate'
-        '?api-version=3.0&from={}&to={}'.format(source_language, dest_language)
-    )
+def translate(text, source_language, dest_language):
+    """
+    Translate text from one language to another.
 
-    r = requests.post(url, headers=auth, json=[{'Text': text}])
+    Args:
+        text (str): The text to translate.
+        source_language (str): The source language code.
+        dest_language (str): The destination language code.
 
-    if r.status_code != 200:
+    Returns:
+        str: The translated text or an error message if the translation fails.
+    """
+    if get_translator() is None:
+        return _('Error: the translation service is not configured.')
+    try:
+        return translate_batch([text], source_language, dest_language)[0]
+    except TranslationError as e:
+        current_app.logger.warning(f'Translation error: {e}')
         return _('Error: the translation service failed.')
-
-    return r.json()[0]['translations'][0]['text']
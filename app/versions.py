@@ -0,0 +1,149 @@
+from hashlib import sha1
+import json
+import secrets
+from time import time
+import redis
+import sqlalchemy as sa
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+from app import db
+
+# Changes whenever any post, or anything shown with posts, changes
+POSTS = 'version:posts'
+# User columns that are shown on profiles and next to posts
+USER_FIELDS = ('username', 'about_me', 'avatar_hash', 'last_seen')
+
+
+def user_key(user_id):
+    """
+    Return the version key of a user, which changes whenever the profile,
+    the counters or the posts of the user change.
+    """
+    return f'version:user:{user_id}'
+
+
+def mark_changed(*keys):
+    """
+    Record version keys to change when the session commits.
+
+    Args:
+        *keys (str): The version keys.
+    """
+    db.session.info.setdefault('versions', set()).update(keys)
+
+
+def after_flush(session, context):
+    changed = session.info.setdefault('versions', set())
+    for obj in session.new | session.dirty | session.deleted:
+        table = getattr(obj, '__tablename__', None)
+        if table == 'post':
+            changed.update((POSTS, user_key(obj.user_id)))
+        elif table == 'user' and obj not in session.new:
+            state = sa.inspect(obj)
+            if obj in session.deleted or any(
+                    state.attrs[field].history.has_changes()
+                    for field in USER_FIELDS):
+                changed.update((POSTS, user_key(obj.id)))
+
+
+def after_commit(session):
+    changed = session.info.pop('versions', None)
+    if not changed:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key in changed:
+            pipe.set(key, secrets.token_hex(8))
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Version update error: {e}')
+
+
+def after_rollback(session):
+    session.info.pop('versions', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def get_versions(keys):
+    """
+    Return the current values of version keys. Keys that do not exist yet
+    are given a random value, so that a key that is lost never brings back
+    an old version.
+
+    Args:
+        keys (list): The version keys.
+
+    Returns:
+        list: The versions, in the order of the keys.
+    """
+    r = current_app.redis
+    values = r.mget(keys)
+    missing = [key for key, value in zip(keys, values) if value is None]
+    if missing:
+        pipe = r.pipeline(transaction=False)
+        for key in missing:
+            pipe.set(key, secrets.token_hex(8), nx=True)
+        pipe.execute()
+        values = r.mget(keys)
+    return [value.decode('utf-8') for value in values]
+
+
+def page_etag(keys, *parts, html=True):
+    """
+    Return the ETag of a response built from versioned data. The versions
+    are read before the data, so an ETag never claims data that is newer
+    than the response it is sent with.
+
+    Args:
+        keys (list): The version keys of the data in the response.
+        *parts: Other values the response depends on.
+        html (bool): Whether the response is a page, which also depends on
+            the language and CSRF tokens of the viewer.
+
+    Returns:
+        str: The ETag, or None if the versions are not available.
+    """
+    if html:
+        keys = keys + [user_key(current_user.id)]
+        limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        # pages are rendered again before their CSRF tokens expire
+        parts += (current_user.id, g.get('locale'),
+                  int(time() // (limit / 2)) if limit else 0)
+    try:
+        versions = get_versions(keys)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f'Version lookup error: {e}')
+        return None
+    return sha1(json.dumps([versions, parts], default=str).encode(
+        'utf-8')).hexdigest()
+
+
+def is_fresh(etag):
+    """
+    Return True if the client already has the response with this ETag.
+    Pages with pending flashed messages are always rendered.
+    """
+    return etag is not None and '_flashes' not in session and \
+        request.if_none_match.contains_weak(etag)
+
+
+def not_modified(etag):
+    return tagged(make_response('', 304), etag)
+
+
+def tagged(response, etag):
+    """
+    Add an ETag to a response, and make clients revalidate it on every use.
+    """
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.update(('Cookie', 'Authorization'))
+    return response
@@ -0,0 +1,39 @@
+from rq import SimpleWorker, Worker
+
+from app import email, preload
+from app.log import flush_logs
+from app.tasks import app
+
+
+class PreloadWorker(Worker):
+    """
+    RQ worker that loads the tasks and warms the application before it
+    forks a process for each job, so that the jobs share them instead of
+    each one importing the tasks and creating the application again.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        preload(app)
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            if self.is_horse:
+                # the forked process exits without running the atexit hooks
+                flush_logs(app)
+
+
+class MailWorker(SimpleWorker):
+    """
+    RQ worker for the mail queue. The jobs run in the worker process instead
+    of a forked one, so the SMTP connection that a job opens stays open for
+    the next ones. The connection is closed when the worker stops.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        preload(app)
+
+    def teardown(self):
+        email.close_connection()
+        super().teardown()
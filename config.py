@@ -10,14 +10,48 @@ class Config:
         'postgres://', 'postgresql://') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_REQUESTS = os.environ.get('LOG_REQUESTS', '1') != '0'
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_MAIL_INTERVAL = 300
+    LOG_MAIL_MAX_PER_INTERVAL = 10
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    MAIL_POOL_SIZE = 2
+    MAIL_RETRY_INTERVALS = [10, 60, 300]
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'westus'
+    TRANSLATOR = os.environ.get('TRANSLATOR')
+    TRANSLATOR_TIMEOUT = (3.05, 10)
+    TRANSLATION_CACHE_SIZE = 1024
+    TRANSLATION_CACHE_TTL = 7 * 24 * 3600
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_REPLICAS = int(os.environ.get('ELASTICSEARCH_REPLICAS') or 0)
+    ELASTICSEARCH_REFRESH_INTERVAL = '1s'
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_INDEX_MAX_ATTEMPTS = 5
+    SEARCH_RESULTS_FROM_INDEX = os.environ.get('SEARCH_RESULTS_FROM_INDEX') is not None
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     POSTS_PER_PAGE = 5
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or \
+        os.path.join(basedir, 'instance', 'exports')
+    EXPORT_BATCH_SIZE = 1000
+    EXPORT_PROGRESS_INTERVAL = 2.0
+    TIMELINE_LENGTH = 800
+    TIMELINE_TTL = 7 * 24 * 3600
+    LAST_SEEN_FLUSH_INTERVAL = 60
+    NOTIFICATION_COALESCE = {'task_progress': 5, 'unread_message_count': 5}
+    NOTIFICATION_STREAM = os.environ.get('NOTIFICATION_STREAM') is not None
+    NOTIFICATION_STREAM_TIMEOUT = 300
+    NOTIFICATION_STREAM_KEEPALIVE = 15
+    TASK_STATUS_TTL = 24 * 3600
+    AVATAR_PROXY = os.environ.get('AVATAR_PROXY') is not None
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, 'instance', 'avatars')
+    AVATAR_CACHE_MAX_BYTES = 100 * 1024 * 1024
+    AVATAR_CACHE_MAX_AGE = 7 * 24 * 3600
+    AVATAR_TIMEOUT = (3.05, 10)
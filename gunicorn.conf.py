@@ -0,0 +1,8 @@
+# Load the application in the master process, so that the workers share it
+# instead of each one creating it
+preload_app = True
+
+
+def when_ready(server):
+    from app import preload
+    preload(server.app.wsgi())
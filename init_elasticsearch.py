@@ -1,28 +1,13 @@
-from elasticsearch import Elasticsearch
-
-def create_index(es, index_name):
-    # Define the index mapping
-    mapping = {
-        "mappings": {
-            "properties": {
-                "title": {"type": "text"},
-                "body": {"type": "text"},
-                "author": {"type": "keyword"},
-                "timestamp": {"type": "date"}
-            }
-        }
-    }
-    
-    # Create the index
-    es.indices.create(index=index_name, body=mapping)
+from app import create_app
+from app.models import SearchableMixin
+from app.search import ensure_index
 
 if __name__ == "__main__":
-    # Replace 'localhost:9200' with your Elasticsearch host URL if different
-    es = Elasticsearch(hosts=["http://localhost:9200"])
-    index_name = "post"
-    
-    if not es.indices.exists(index=index_name):
-        create_index(es, index_name)
-        print(f"Index '{index_name}' created.")
-    else:
-        print(f"Index '{index_name}' already exists.")
+    # Uses ELASTICSEARCH_URL and the index definitions of the application,
+    # the same as "flask search init"
+    app = create_app()
+    with app.app_context():
+        if not app.elasticsearch:
+            raise SystemExit("ELASTICSEARCH_URL is not set.")
+        for alias, model in SearchableMixin.searchable_models().items():
+            print(f"Index '{alias}' -> '{ensure_index(model)}'.")
@@ -1,8 +1,35 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+import gzip
+import json
+import logging
+import os
+import smtplib
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+import fakeredis
+import redis
+import sqlalchemy as sa
+from elasticsearch import Elasticsearch
+from flask_login import FlaskLoginClient
+from app import avatars, create_app, db, email, exports, mail, presence, \
+    timeline, translate, versions
+from app.cli import backfill_languages, reconcile_counters, \
+    reconcile_unread_messages
+from app.log import JSONFormatter, RateLimitedSMTPHandler, flush_logs, \
+    init_logging
+from app.models import User, Post, PostHit, Comment, IndexOutbox, \
+    Message, Notification, Task, followers
+from app.pagination import encode_cursor, paginate
+from app.search import ensure_index, rebuild_index
+from app.search.backend import UnmanagedIndexError
+from app.search.elastic import ElasticsearchBackend, index_definition, \
+    index_version
+from app.worker import MailWorker
 from config import Config
 
 
@@ -11,6 +38,16 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 
+def unavailable_redis():
+    # a client of a Redis server that cannot be reached
+    client = mock.Mock(spec=redis.Redis)
+    for name in dir(redis.Redis):
+        if not name.startswith('_'):
+            getattr(client, name).side_effect = \
+                redis.exceptions.ConnectionError('Connection refused')
+    return client
+
+
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -23,6 +60,14 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def file_app(self, directory):
+        # a database file can be opened by several connections and processes
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                directory, 'app.db')
+            SEARCH_BACKEND = 'database'
+        return create_app(FileConfig)
+
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -34,6 +79,353 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'John@Example.com'
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+
+    def test_avatar_proxy(self):
+        digest = 'd4c74594d841139328695756648b6bd6'
+        response = mock.Mock(status_code=200, content=b'image',
+                             headers={'Content-Type': 'image/jpeg'})
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['AVATAR_CACHE_DIR'] = directory
+            self.app.test_client_class = FlaskLoginClient
+            client = self.app.test_client(user=u)
+            self.assertEqual(client.get(f'/avatar/{digest}/64').status_code,
+                             404)
+            self.app.config['AVATAR_PROXY'] = True
+            with self.app.test_request_context():
+                self.assertEqual(u.avatar(64), f'/avatar/{digest}/64')
+                self.assertEqual(u.avatar(65), avatars.gravatar_url(digest,
+                                                                    65))
+            # only signed in users, the avatars of users and the sizes the
+            # pages use are proxied
+            self.assertEqual(self.app.test_client().get(
+                f'/avatar/{digest}/64').status_code, 302)
+            for url in ('/avatar/nothex/64', f'/avatar/{digest}/65',
+                        f'/avatar/{"0" * 32}/64'):
+                self.assertEqual(client.get(url).status_code, 404)
+            with mock.patch('requests.get', return_value=response) as get:
+                for _ in range(2):
+                    rv = client.get(f'/avatar/{digest}/64')
+                    self.assertEqual(rv.data, b'image')
+                    self.assertEqual(rv.mimetype, 'image/jpeg')
+                    self.assertIn('max-age', rv.headers['Cache-Control'])
+                    rv.close()
+                self.assertEqual(get.call_count, 1)
+
+                # the least recently used avatars make room for new ones
+                self.app.config['AVATAR_CACHE_MAX_BYTES'] = 10
+                old = avatars.cache_path(directory, digest, 64)
+                os.utime(old, (0, 0))
+                client.get(f'/avatar/{digest}/128').close()
+                client.get(f'/avatar/{digest}/200').close()
+                self.assertFalse(os.path.exists(old))
+                self.assertTrue(os.path.exists(
+                    avatars.cache_path(directory, digest, 200)))
+
+    def test_token(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        self.assertEqual(u.get_token(), token)
+        self.assertEqual(User.check_token(token), u)
+        self.assertIsNone(User.check_token('nope'))
+        u.revoke_token()
+        self.assertEqual(db.session.info['revoked_tokens'], [token])
+        db.session.commit()
+        self.assertNotIn('revoked_tokens', db.session.info)
+        self.assertIsNone(User.check_token(token))
+        self.assertNotEqual(u.get_token(), token)
+
+    def test_user_serialization(self):
+        u1 = User()
+        u1.from_dict({'username': 'john', 'email': 'john@example.com',
+                      'password': 'cat'}, new_user=True)
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='a', author=u1),
+                            Post(body='b', author=u1)])
+        db.session.commit()
+        self.assertTrue(u1.check_password('cat'))
+        with self.app.test_request_context():
+            data = User.to_dicts([u1, u2])
+            self.assertEqual([d['post_count'] for d in data], [2, 0])
+            self.assertEqual(data[0], u1.to_dict())
+            self.assertEqual(User.to_dicts([u1], fields=['username']),
+                             [{'id': u1.id, 'username': 'john'}])
+
+    def test_api_users(self):
+        self.app.redis = fakeredis.FakeRedis()
+        users = [User(username=name, email=f'{name}@example.com')
+                 for name in ('john', 'susan', 'mary')]
+        db.session.add_all(users + [Post(body='a', author=users[1]),
+                                    Post(body='b', author=users[1])])
+        db.session.commit()
+        token = users[0].get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        rv = client.get('/api/users?per_page=2&fields=username,post_count',
+                        headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/json')
+        data = rv.get_json()
+        self.assertEqual(data['items'], [
+            {'id': users[2].id, 'username': 'mary', 'post_count': 0},
+            {'id': users[1].id, 'username': 'susan', 'post_count': 2}])
+        self.assertEqual(data['_meta']['per_page'], 2)
+        # the field selection is carried to the next page
+        self.assertIn('fields=username', data['_links']['next'])
+        rv = client.get(data['_links']['next'], headers=headers)
+        self.assertEqual(rv.get_json()['items'], [
+            {'id': users[0].id, 'username': 'john', 'post_count': 0}])
+        self.assertIsNone(rv.get_json()['_links']['next'])
+
+    def test_version_keys(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body='post from john', author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        u2.like_post(p)
+        db.session.flush()
+        self.assertEqual(db.session.info['versions'],
+                         {versions.POSTS, versions.user_key(u1.id)})
+        db.session.commit()
+        self.assertNotIn('versions', db.session.info)
+        u2.follow(u1)
+        u2.about_me = 'hi'
+        db.session.flush()
+        self.assertEqual(db.session.info['versions'],
+                         {versions.POSTS, versions.user_key(u1.id),
+                          versions.user_key(u2.id)})
+        db.session.rollback()
+        self.assertNotIn('versions', db.session.info)
+
+    def test_conditional_requests(self):
+        self.app.redis = fakeredis.FakeRedis()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body='post from susan', author=u2)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        token = u1.get_token()
+        db.session.commit()
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=u1)
+        api = {'Authorization': f'Bearer {token}'}
+        urls = {'/explore': {}, '/user/susan': {},
+                '/user/susan/popup': {}, f'/api/users/{u2.id}': api}
+        etags = {}
+
+        def check(changed):
+            for url, headers in urls.items():
+                rv = client.get(url, headers={
+                    **headers, 'If-None-Match': f'"{etags.get(url)}"'})
+                etag = rv.get_etag()[0]
+                if url in changed:
+                    self.assertEqual(rv.status_code, 200, url)
+                    self.assertNotEqual(etag, etags.get(url), url)
+                else:
+                    self.assertEqual(rv.status_code, 304, url)
+                    self.assertEqual(etag, etags[url], url)
+                etags[url] = etag
+                rv = client.get(url, headers={
+                    **headers, 'If-None-Match': f'"{etag}"'})
+                self.assertEqual(rv.status_code, 304, url)
+                self.assertEqual(rv.data, b'')
+
+        check(urls)
+        check(())
+        db.session.add(Post(body='another post from susan', author=u2))
+        db.session.commit()
+        check(urls)
+        u1.like_post(p)
+        db.session.commit()
+        check(urls)
+        u1.follow(u2)
+        db.session.commit()
+        check(urls)
+        # the pages show the unread message count of the viewer
+        u1.receive_message(Message(author=u2, recipient=u1, body='hi'))
+        db.session.commit()
+        check(('/explore', '/user/susan', '/user/susan/popup'))
+        # pending flashed messages are always rendered
+        with client.session_transaction() as session:
+            session['_flashes'] = [('message', 'hi')]
+        rv = client.get('/explore', headers={
+            'If-None-Match': f'"{etags["/explore"]}"'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'hi', rv.data)
+
+    def test_unread_messages(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for body in ('hi', 'there'):
+            count = u2.receive_message(
+                Message(author=u1, recipient=u2, body=body))
+        db.session.commit()
+        self.assertEqual(count, 2)
+        self.assertEqual(u2.unread_message_count(), 2)
+        u2.read_messages()
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 0)
+        db.session.add(Message(author=u1, recipient=u2, body='again',
+                               timestamp=datetime.now(timezone.utc) +
+                               timedelta(seconds=1)))
+        db.session.commit()
+        self.assertEqual(reconcile_unread_messages(1), 1)
+        db.session.refresh(u2)
+        self.assertEqual(u2.unread_message_count(), 1)
+
+    def test_tasks_in_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([
+            u, Task(id='a', name='export_posts', description='A', user=u),
+            Task(id='b', name='export_posts', description='B', user=u,
+                 complete=True)])
+        db.session.commit()
+        # without Redis, the tasks are read from the database
+        self.app.redis = unavailable_redis()
+        self.assertEqual([task.id for task in u.get_tasks_in_progress()],
+                         ['a'])
+        self.assertEqual(u.get_task_in_progress('export_posts').id, 'a')
+
+    def test_task_tracking(self):
+        self.app.redis = fakeredis.FakeRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        task = u.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        with mock.patch('app.models.time', return_value=time.time() + 1):
+            Task.track(u.id, 'b', 'B')
+        tasks, progress = Task.status_keys(u.id)
+        self.assertGreater(self.app.redis.ttl(tasks), 0)
+        Task.record_progress(u.id, task.id, 50)
+        self.assertEqual(
+            [(t.id, t.description, t.progress) for t in Task.tracked(u.id)],
+            [(task.id, 'Exporting posts...', 50), ('b', 'B', 0)])
+        # Redis is read instead of the database
+        self.assertEqual([t.id for t in u.get_tasks_in_progress()],
+                         [task.id, 'b'])
+        # tasks stop being tracked when they finish or fail
+        Task.record_progress(u.id, 'b', 100)
+        self.assertEqual([t.id for t in Task.tracked(u.id)], [task.id])
+        Task.record_progress(u.id, task.id, 60, complete=True)
+        self.assertEqual(Task.tracked(u.id), [])
+        self.assertFalse(self.app.redis.exists(tasks, progress))
+        self.assertEqual(u.get_tasks_in_progress(), [])
+
+    def test_deliver_batch(self):
+        messages = [{'subject': f'message {i}', 'sender': 'a@example.com',
+                     'recipients': ['b@example.com'], 'text_body': 'text',
+                     'html_body': '<p>text</p>'} for i in range(3)]
+        with mail.record_messages() as outbox:
+            self.assertEqual(email.deliver_batch(messages, sent=1), 2)
+        self.assertEqual([m.subject for m in outbox],
+                         ['message 1', 'message 2'])
+        with mock.patch('flask_mail.Connection.send', side_effect=[
+                smtplib.SMTPServerDisconnected(), None,
+                smtplib.SMTPRecipientsRefused({}),
+                smtplib.SMTPServerDisconnected(),
+                smtplib.SMTPServerDisconnected()]) as send:
+            # reconnects once, then gives up on a refused message
+            self.assertEqual(email.deliver_batch(messages[:2]), 1)
+            with self.assertRaises(email.TransientMailError):
+                email.deliver_batch(messages[:1])
+            self.assertEqual(send.call_count, 5)
+        email.close_connection()
+
+    def test_mail_worker(self):
+        self.app.redis = fakeredis.FakeRedis()
+        messages = [{'subject': f'message {i}', 'sender': 'a@example.com',
+                     'recipients': ['b@example.com'], 'text_body': 'text',
+                     'html_body': '<p>text</p>'} for i in range(2)]
+        for message in messages:
+            email.send_email(**message)
+        self.assertEqual(self.app.mail_queue.count, 2)
+        self.assertEqual(self.app.task_queue.count, 0)
+        connection = mock.MagicMock()
+        worker = MailWorker([self.app.mail_queue], connection=self.app.redis)
+        # the worker's signal handlers would outlive the test
+        with mock.patch.object(mail, 'connect') as connect, \
+                mock.patch.object(worker, '_install_signal_handlers'):
+            connect.return_value.__enter__.return_value = connection
+            worker.work(burst=True)
+        # both jobs are sent over one connection, closed when the worker stops
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(connection.send.call_count, 2)
+        connection.__exit__.assert_called_once()
+        self.assertIsNone(email._connection)
+
+    def test_forked_logs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'app.log')
+            init_logging(self.app, [logging.FileHandler(path)])
+            pid = os.fork()
+            if pid == 0:
+                # like the task worker, the child exits without atexit hooks
+                self.app.logger.info('from the child')
+                flush_logs(self.app)
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self.app.logger.info('from the parent')
+            flush_logs(self.app)
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(),
+                                 ['from the child', 'from the parent'])
+
+    def test_error_mail_rate_limit(self):
+        handler = RateLimitedSMTPHandler(
+            'localhost', 'no-reply@example.com', ['admin@example.com'],
+            'Failure', interval=60, max_per_interval=2)
+
+        def record(lineno):
+            return logging.LogRecord('app', logging.ERROR, 'app.py', lineno,
+                                     'failed', None, None)
+
+        with mock.patch('logging.handlers.SMTPHandler.emit') as emit:
+            for lineno in (1, 1, 1, 2, 3):
+                handler.emit(record(lineno))
+            # one mail per location, and two per interval
+            self.assertEqual([call.args[0].lineno for call in emit.mock_calls],
+                             [1, 2])
+            handler.sent.clear()
+            handler.window = (0, 0)
+            handler.emit(record(1))
+            self.assertIn('2 more errors', emit.call_args.args[0].msg)
+        line = json.loads(JSONFormatter().format(record(1)))
+        self.assertEqual((line['level'], line['message']), ('ERROR', 'failed'))
+
+    def test_import_time(self):
+        # in a new interpreter, the tests have imported everything already
+        script = (
+            'import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'from app import create_app\n'
+            'from config import Config\n'
+            'class TestConfig(Config):\n'
+            '    TESTING = True\n'
+            '    SQLALCHEMY_DATABASE_URI = "sqlite://"\n'
+            'create_app(TestConfig)\n'
+            'print(json.dumps([time.perf_counter() - start, [\n'
+            '    m for m in ("elasticsearch", "langdetect", "rq", "requests")\n'
+            '    if m in sys.modules]]))\n')
+        elapsed, loaded = json.loads(subprocess.run(
+            [sys.executable, '-c', script], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout)
+        self.assertEqual(loaded, [])
+        self.assertLess(elapsed, 3.0)
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -100,6 +492,788 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        self.app.redis = fakeredis.FakeRedis()
+        self.app.config['TIMELINE_LENGTH'] = 4
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u2,
+                      timestamp=now + timedelta(seconds=i)) for i in range(6)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # there is no timeline yet, so the page is read from the database
+        self.assertIsNone(timeline.get_page(u1, None, 2))
+        timeline.rebuild(u1)
+        page = timeline.get_page(u1, None, 2)
+        self.assertEqual(page.items, [posts[5], posts[4]])
+
+        # new posts go to the timelines that exist, which stay trimmed
+        p = Post(body='new post', author=u2,
+                 timestamp=now + timedelta(seconds=10))
+        db.session.add(p)
+        db.session.commit()
+        timeline.fan_out(p)
+        self.assertEqual(self.app.redis.zcard(f'timeline:{u1.id}'), 4)
+        self.assertEqual(self.app.redis.zcard(f'timeline:{u2.id}'), 0)
+        self.assertFalse(self.app.redis.exists(f'timeline:{u3.id}'))
+        page = timeline.get_page(u1, None, 2)
+        self.assertEqual(page.items, [p, posts[5]])
+
+        # pages past the cached posts are read from the database
+        self.assertIsNone(timeline.get_page(u1, page.next_cursor, 2))
+        page = paginate(u1.following_posts(), (Post.timestamp, Post.id),
+                        page.next_cursor, 2)
+        self.assertEqual(page.items, [posts[4], posts[3]])
+
+        # a timeline with the whole feed serves its last page too
+        self.app.config['TIMELINE_LENGTH'] = 10
+        timeline.rebuild(u2)
+        page = timeline.get_page(u2, None, 5)
+        page = timeline.get_page(u2, page.next_cursor, 5)
+        self.assertEqual(page.items, [posts[1], posts[0]])
+        self.assertFalse(page.has_next)
+
+    def test_timeline_prev(self):
+        self.app.redis = fakeredis.FakeRedis()
+        self.app.config['TIMELINE_LENGTH'] = 6
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u,
+                      timestamp=now + timedelta(seconds=i))
+                 for i in range(20)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        columns = (Post.timestamp, Post.id)
+        pages = [paginate(u.following_posts(), columns, None, 3)]
+        for _ in range(3):
+            pages.append(paginate(u.following_posts(), columns,
+                                  pages[-1].next_cursor, 3))
+
+        # without a timeline, going back is left to the database too
+        self.assertIsNone(timeline.get_page(u, pages[3].prev_cursor, 3))
+        timeline.rebuild(u)
+        # the posts before the fourth page are not all cached
+        self.assertIsNone(timeline.get_page(u, pages[3].prev_cursor, 3))
+        page = timeline.get_page(u, pages[1].prev_cursor, 3)
+        self.assertEqual(page.items, pages[0].items)
+        self.assertFalse(page.has_prev)
+
+    def test_timeline_follow(self):
+        self.app.redis = fakeredis.FakeRedis()
+        self.app.config['TIMELINE_LENGTH'] = 4
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        u4 = User(username='david', email='david@example.com')
+        db.session.add_all([u1, u2, u3, u4])
+        now = datetime.now(timezone.utc)
+        for author, seconds in ((u2, range(4)), (u3, (10, 11, 12)),
+                                (u4, (0.5, 1.5, 11.5))):
+            db.session.add_all([
+                Post(body=f'post {s}', author=author,
+                     timestamp=now + timedelta(seconds=s)) for s in seconds])
+        db.session.commit()
+        key = f'timeline:{u1.id}'
+
+        def cached():
+            return [int(id) for id in self.app.redis.zrevrange(key, 0, -1)
+                    if id != b'-']
+
+        def feed():
+            return [post.id for post in db.session.scalars(
+                u1.following_posts())]
+
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        timeline.rebuild(u1)
+        self.assertEqual(cached(), feed()[:4])
+
+        u1.unfollow(u3)
+        db.session.commit()
+        timeline.remove_author(u1, u3)
+        self.assertEqual(cached(), feed()[:1])
+
+        # only the posts newer than the oldest cached one are added, so the
+        # timeline still starts the feed without gaps
+        u1.follow(u4)
+        db.session.commit()
+        timeline.add_author(u1, u4)
+        self.assertEqual(cached(), feed()[:2])
+        timeline.rebuild(u1)
+        self.assertEqual(cached(), feed()[:4])
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        # two posts share each timestamp, so ties are broken by id
+        posts = [Post(body=f'post {i}', author=u,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+
+        columns = (Post.timestamp, Post.id)
+        pages = [paginate(sa.select(Post), columns, None, 3)]
+        while pages[-1].has_next:
+            pages.append(paginate(sa.select(Post), columns,
+                                  pages[-1].next_cursor, 3))
+        self.assertEqual([len(page.items) for page in pages], [3, 3, 1])
+        self.assertEqual([p for page in pages for p in page.items], expected)
+        self.assertFalse(pages[0].has_prev)
+
+        prev = paginate(sa.select(Post), columns, pages[2].prev_cursor, 3)
+        self.assertEqual(prev.items, pages[1].items)
+        self.assertTrue(prev.has_next)
+        self.assertTrue(prev.has_prev)
+        prev = paginate(sa.select(Post), columns, prev.prev_cursor, 3)
+        self.assertEqual(prev.items, pages[0].items)
+        self.assertFalse(prev.has_prev)
+
+        page = paginate(sa.select(Post), columns, 'not-a-cursor', 3)
+        self.assertEqual(page.items, pages[0].items)
+
+    def test_feed_query_plans(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if statement.startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        columns = (Post.timestamp, Post.id)
+        cursor = encode_cursor([datetime.now(timezone.utc), 1])
+        queries = [sa.select(Post), u.following_posts()]
+        sa.event.listen(db.engine, 'before_cursor_execute', capture)
+        for query in queries:
+            paginate(query, columns, cursor, 5)
+        sa.event.remove(db.engine, 'before_cursor_execute', capture)
+        explore, followed = [' | '.join(
+            row[3] for row in db.session.connection().exec_driver_sql(
+                f'EXPLAIN QUERY PLAN {statement}', parameters))
+            for statement, parameters in statements]
+        # explore reads the index in page order, without sorting
+        self.assertIn('post USING INDEX ix_post_timestamp_id', explore)
+        self.assertNotIn('TEMP B-TREE', explore)
+        # the followed posts are read by author from the cursor on
+        self.assertIn('SEARCH post USING INDEX ix_post_user_id_timestamp_id '
+                      '(user_id=? AND timestamp<?)', followed)
+        self.assertNotIn('SCAN post', followed)
+
+    def test_card_stats(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        posts = [Post(body=f'post {i}', author=u1 if i % 2 else u2)
+                 for i in range(4)]
+        db.session.add_all([u1, u2] + posts)
+        db.session.commit()
+        u1.like_post(posts[0])
+        u2.like_post(posts[0])
+        u2.like_post(posts[1])
+        db.session.commit()
+        viewer_id = u1.id
+        db.session.expunge_all()
+
+        posts = db.session.scalars(sa.select(Post)).all()
+        viewer = db.session.get(User, viewer_id)
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        Post.load_card_stats(posts, viewer)
+        loaded = len(statements)
+        cards = {post.body: (post.author.username, post.like_count,
+                             post.comment_count, viewer.has_liked_post(post))
+                 for post in posts}
+        sa.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(loaded, 2)
+        self.assertEqual(len(statements), loaded)
+        self.assertEqual(cards, {'post 0': ('susan', 2, 0, True),
+                                 'post 1': ('john', 1, 0, False),
+                                 'post 2': ('susan', 0, 0, False),
+                                 'post 3': ('john', 0, 0, False)})
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body='post from susan', author=u2)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        u1.like_post(p)
+        u1.comment_on_post(p, 'nice')
+        u2.comment_on_post(p, 'thanks')
+        db.session.commit()
+        self.assertEqual(p.like_count, 1)
+        self.assertEqual(p.comment_count, 2)
+        u1.unlike_post(p)
+        db.session.commit()
+        self.assertEqual(p.like_count, 0)
+
+        # simulate drift and repair it
+        db.session.execute(sa.update(Post).values(num_comments=7))
+        db.session.execute(sa.update(User).values(num_followers=3))
+        db.session.commit()
+        self.assertEqual(reconcile_counters(User, {
+            'num_followers': followers.c.followed_id}, 1), 2)
+        self.assertEqual(reconcile_counters(Post, {
+            'num_comments': Comment.post_id}, 1), 1)
+        self.assertEqual(p.comment_count, 2)
+        self.assertEqual(u1.followers_count(), 0)
+
+    def test_apply_index_changes(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first post', author=u)
+        p2 = Post(body='second post', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        with mock.patch('app.models.bulk_update_index',
+                        return_value=[]) as bulk:
+            self.assertEqual(Post.apply_index_changes([
+                ['post', p1.id, 'index'], ['post', p2.id, 'index'],
+                ['post', p1.id, 'index'], ['post', p2.id, 'delete'],
+                ['post', p2.id + 1, 'index']]), [])
+        # one bulk request with the last change of each object, and objects
+        # that no longer exist are deleted from the index
+        bulk.assert_called_once()
+        actions = bulk.call_args.args[0]
+        self.assertEqual([action[:3] for action in actions],
+                         [('post', 'index', p1.id), ('post', 'delete', p2.id),
+                          ('post', 'delete', p2.id + 1)])
+        self.assertEqual(actions[0][3]['body'], 'first post')
+
+    def test_index_outbox(self):
+        # nothing listens on this port, so every index request fails
+        self.app.elasticsearch = Elasticsearch('http://localhost:1')
+        self.app.config['SEARCH_INDEX_MAX_ATTEMPTS'] = 2
+        u = User(username='john', email='john@example.com')
+        p = Post(body='post from john', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        p.num_likes = 1
+        db.session.commit()
+        p.body = 'edited post from john'
+        db.session.commit()
+        rows = db.session.scalars(sa.select(IndexOutbox)).all()
+        self.assertEqual([(r.index_name, r.object_id, r.op) for r in rows],
+                         [('post', p.id, 'index'), ('post', p.id, 'index')])
+
+        self.assertEqual(IndexOutbox.drain(), 0)
+        rows = db.session.scalars(sa.select(IndexOutbox)).all()
+        self.assertEqual([r.attempts for r in rows], [1, 1])
+        self.assertEqual(IndexOutbox.drain(), 0)
+        rows = db.session.scalars(sa.select(IndexOutbox)).all()
+        self.assertEqual(rows, [])
+
+    def test_search_hits(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        p = Post(body='hello <world>', author=u1, language='en')
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        u2.like_post(p)
+        db.session.commit()
+
+        document = p.search_document()
+        self.assertEqual(document['author'], {
+            'username': 'john', 'avatar': u1.avatar_digest()})
+        hit = PostHit({'id': p.id, 'source': document, 'highlight': {
+            'body': '&lt;<mark>world</mark>&gt;'}})
+        self.assertEqual(str(hit.body), '&lt;<mark>world</mark>&gt;')
+        self.assertEqual(hit.author.avatar(60), u1.avatar(60))
+        self.assertEqual(hit.timestamp, p.timestamp)
+
+        Post.load_card_stats([hit], u2)
+        self.assertEqual(hit.like_count, 1)
+        self.assertEqual(hit.comment_count, 0)
+        self.assertTrue(u2.has_liked_post(hit))
+
+        # a renamed author is copied again into the documents of its posts
+        self.app.elasticsearch = Elasticsearch('http://localhost:1')
+        db.session.execute(sa.delete(IndexOutbox))
+        u1.about_me = 'hi'
+        db.session.commit()
+        self.assertEqual(db.session.scalars(sa.select(IndexOutbox)).all(), [])
+        u1.username = 'johnny'
+        db.session.commit()
+        rows = db.session.scalars(sa.select(IndexOutbox)).all()
+        self.assertEqual([(r.index_name, r.object_id, r.op) for r in rows],
+                         [('post', p.id, 'index')])
+
+    def test_elastic_index_definition(self):
+        definition = index_definition(Post)
+        properties = definition['mappings']['properties']
+        self.assertEqual(properties['body'],
+                         {'type': 'text', 'analyzer': 'folding'})
+        self.assertEqual(properties['author'], Post.__search_mapping__[
+            'author'])
+        self.assertFalse(definition['mappings']['dynamic'])
+        version = index_version(Post)
+        self.assertEqual(len(version), 8)
+        self.assertEqual(index_version(Post), version)
+        self.app.config['ELASTICSEARCH_REPLICAS'] = 2
+        self.assertNotEqual(index_version(Post), version)
+
+    def test_elastic_ensure_index(self):
+        client = mock.Mock()
+        backend = ElasticsearchBackend(client)
+        index = f'post-{index_version(Post)}'
+        client.indices.exists_alias.return_value = False
+        client.indices.exists.return_value = False
+        self.assertEqual(backend.ensure_index(Post), index)
+        client.indices.create.assert_called_once_with(
+            index=index, **index_definition(Post))
+        client.indices.update_aliases.assert_called_once_with(
+            actions=[{'add': {'index': index, 'alias': 'post'}}])
+
+        client.reset_mock()
+        client.indices.exists_alias.return_value = True
+        client.indices.get_alias.return_value = {'post-old': {}}
+        self.assertEqual(backend.ensure_index(Post), 'post-old')
+        client.indices.create.assert_not_called()
+        client.indices.update_aliases.assert_not_called()
+
+        # an index from before aliases were used is never replaced
+        client.reset_mock()
+        client.indices.exists_alias.return_value = False
+        client.indices.exists.side_effect = lambda index: index == 'post'
+        with self.assertRaises(UnmanagedIndexError):
+            backend.ensure_index(Post)
+        self.app.elasticsearch = client
+        self.app.config['SEARCH_BACKEND'] = None
+        result = self.app.test_cli_runner().invoke(args=['search', 'init'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('flask search rebuild', result.output)
+        client.indices.create.assert_not_called()
+        client.indices.update_aliases.assert_not_called()
+        client.indices.delete.assert_not_called()
+
+    def test_elastic_rebuild_index(self):
+        self.app.redis = fakeredis.FakeRedis()
+        client = mock.Mock()
+        backend = ElasticsearchBackend(client)
+        client.indices.exists_alias.return_value = True
+        client.indices.exists.return_value = True
+        client.indices.get_alias.return_value = {'post-old': {}}
+        built = []
+
+        def reindex(**kwargs):
+            # changes are written to the new index while it is built, and
+            # the alias moves only once it is loaded
+            built.append(self.app.redis.get('search:building:post'))
+            client.indices.update_aliases.assert_not_called()
+            self.assertEqual(kwargs['index'], built[0].decode('utf-8'))
+
+        with mock.patch.object(Post, 'reindex', side_effect=reindex):
+            index = backend.rebuild_index(Post)
+        self.assertEqual(built, [index.encode('utf-8')])
+        self.assertTrue(index.startswith(f'post-{index_version(Post)}-'))
+        client.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove': {'index': 'post-old', 'alias': 'post'}},
+            {'add': {'index': index, 'alias': 'post'}}])
+        client.indices.delete.assert_called_once_with(
+            index='post-old', ignore_unavailable=True)
+        self.assertFalse(self.app.redis.exists('search:building:post'))
+
+        # an index from before aliases were used is replaced after the
+        # rebuild
+        client.reset_mock()
+        client.indices.exists_alias.return_value = False
+        with mock.patch.object(Post, 'reindex'):
+            index = backend.rebuild_index(Post)
+        client.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove_index': {'index': 'post'}},
+            {'add': {'index': index, 'alias': 'post'}}])
+
+    def test_elastic_bulk_update(self):
+        self.app.redis = fakeredis.FakeRedis()
+        backend = ElasticsearchBackend(mock.Mock())
+        operations = []
+
+        def streaming_bulk(client, actions, **kwargs):
+            for action in actions:
+                operations.append(action)
+                op = action['_op_type']
+                if action['_id'] == 3:
+                    yield False, {op: {'status': 404}}
+                elif action['_id'] == 2 and action['_index'] == 'post-new':
+                    yield False, {op: {'status': 400, 'error': 'bad'}}
+                else:
+                    yield True, {op: {'status': 200}}
+
+        actions = [('post', 'index', 1, {'body': 'a'}),
+                   ('post', 'index', 2, {'body': 'b'}),
+                   ('post', 'delete', 3, None)]
+        with mock.patch('app.search.elastic.helpers.streaming_bulk',
+                        side_effect=streaming_bulk):
+            self.assertEqual(backend.bulk_update(actions), [])
+            self.assertEqual([(o['_index'], o['_id']) for o in operations],
+                             [('post', 1), ('post', 2), ('post', 3)])
+            # while an index is rebuilt, changes are written to both
+            operations.clear()
+            self.app.redis.set('search:building:post', 'post-new')
+            self.assertEqual(backend.bulk_update(actions),
+                             [('post', 'index', 2, 'bad')])
+        self.assertEqual(operations, [
+            {'_op_type': 'index', '_index': 'post', '_id': 1,
+             '_source': {'body': 'a'}},
+            {'_op_type': 'index', '_index': 'post-new', '_id': 1,
+             '_source': {'body': 'a'}},
+            {'_op_type': 'index', '_index': 'post', '_id': 2,
+             '_source': {'body': 'b'}},
+            {'_op_type': 'index', '_index': 'post-new', '_id': 2,
+             '_source': {'body': 'b'}},
+            {'_op_type': 'delete', '_index': 'post', '_id': 3},
+            {'_op_type': 'delete', '_index': 'post-new', '_id': 3}])
+
+    def test_database_search(self):
+        self.app.elasticsearch = None
+        ensure_index(Post)
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the café is open', author=u)
+        p2 = Post(body='a cafe and a <b>bakery</b>', author=u)
+        p3 = Post(body='nothing to see', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('cafe', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts), {p1, p2})
+        posts, total = Post.search('cafe', 2, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(Post.search('"', 1, 10), ([], 0))
+
+        hits, total = Post.search_hits('bakery', 1, 10)
+        self.assertEqual([hit.id for hit in hits], [p2.id])
+        self.assertEqual(str(hits[0].body),
+                         'a cafe and a &lt;b&gt;<mark>bakery</mark>&lt;/b&gt;')
+        self.assertEqual(hits[0].author.username, 'john')
+
+        # changes are indexed in the same transaction
+        p3.body = 'a new cafe'
+        db.session.commit()
+        self.assertEqual(Post.search('cafe', 1, 10)[1], 3)
+        self.assertEqual(db.session.scalars(sa.select(IndexOutbox)).all(), [])
+
+    def test_database_search_table(self):
+        self.app.elasticsearch = None
+        # the index table is created by the first search or index update
+        self.assertEqual(Post.search('cafe', 1, 10), ([], 0))
+        u = User(username='john', email='john@example.com')
+        p = Post(body='the cafe is open', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.assertEqual(Post.search('cafe', 1, 10), ([p], 1))
+        self.assertEqual(db.session.scalars(sa.select(IndexOutbox)).all(), [])
+
+        # an index table that went missing has no results until it is
+        # created again
+        db.session.execute(sa.text('DROP TABLE search_post'))
+        db.session.commit()
+        self.assertEqual(Post.search('cafe', 1, 10), ([], 0))
+        self.assertEqual(Post.search('cafe', 1, 10), ([], 0))
+        p.body = 'the cafe is closed'
+        db.session.commit()
+        self.assertEqual(Post.search('cafe', 1, 10), ([p], 1))
+
+    def test_database_rebuild_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.file_app(directory).app_context():
+                db.create_all()
+                u = User(username='john', email='john@example.com')
+                db.session.add_all([u] + [Post(body=f'post {i}', author=u)
+                                          for i in range(50)])
+                db.session.commit()
+                db.session.execute(sa.text('DELETE FROM search_post'))
+                db.session.commit()
+                calls = []
+                rebuild_index(Post, chunk_size=10, progress=lambda *args:
+                              calls.append(args[:2]))
+                self.assertEqual(calls[-1], (50, 0))
+                self.assertEqual(len(calls), 5)
+                self.assertEqual(Post.search('post', 1, 10)[1], 50)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_reindex(self):
+        self.app.elasticsearch = None
+        self.app.redis = fakeredis.FakeRedis()
+        ensure_index(Post)
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i}', author=u) for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        db.session.execute(sa.text('DELETE FROM search_post'))
+        db.session.commit()
+        calls = []
+        self.assertEqual(Post.reindex(chunk_size=2, progress=lambda *args:
+                                      calls.append(args[:2])), (5, 0))
+        self.assertEqual(calls, [(2, 0), (4, 0), (5, 0)])
+        self.assertEqual(Post.search('post', 1, 10)[1], 5)
+        self.assertFalse(self.app.redis.exists('search:reindex:post'))
+
+        # an interrupted run resumes after the last indexed chunk
+        self.app.redis.set('search:reindex:post', posts[2].id)
+        self.assertEqual(Post.reindex(chunk_size=2), (2, 0))
+        self.assertEqual(Post.reindex(chunk_size=2, resume=False), (5, 0))
+
+    def test_reindex_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.file_app(directory).app_context():
+                db.create_all()
+                ensure_index(Post)
+                u = User(username='john', email='john@example.com')
+                db.session.add_all([u] + [Post(body=f'post {i}', author=u)
+                                          for i in range(10)])
+                db.session.commit()
+                db.session.execute(sa.text('DELETE FROM search_post'))
+                db.session.commit()
+                # the workers open the same database as this application
+                self.assertEqual(Post.reindex(chunk_size=3, workers=2),
+                                 (10, 0))
+                self.assertEqual(Post.search('post', 1, 20)[1], 10)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_last_seen(self):
+        self.app.redis = fakeredis.FakeRedis()
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime.now(timezone.utc) - timedelta(hours=1))
+        db.session.add(u)
+        db.session.commit()
+        old = u.last_seen
+        presence.record_seen(u)
+        presence.record_seen(u)
+        # the time is buffered, and one flush is scheduled for the interval
+        seen = float(self.app.redis.hget(presence.PENDING, str(u.id)))
+        self.assertEqual(u.last_seen, old)
+        self.assertEqual(
+            len(self.app.task_queue.scheduled_job_registry.get_job_ids()), 1)
+        presence.load_last_seen(u)
+        self.assertEqual(u.last_seen.timestamp(), seen)
+        self.assertNotIn(u, db.session.dirty)
+        self.assertEqual(presence.flush_last_seen(), 1)
+        self.assertFalse(self.app.redis.exists(presence.PENDING))
+        stored = db.session.scalar(
+            sa.select(User.last_seen).where(User.id == u.id))
+        self.assertAlmostEqual(
+            stored.replace(tzinfo=timezone.utc).timestamp(), seen, places=3)
+        self.assertEqual(presence.flush_last_seen(), 0)
+
+    def test_last_seen_fallback(self):
+        # without Redis the time is written directly, but only once the
+        # stored one is older than the flush interval
+        self.app.redis = unavailable_redis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        recent = u.last_seen
+        presence.record_seen(u)
+        self.assertEqual(u.last_seen, recent)
+        u.last_seen = datetime.now(timezone.utc) - timedelta(hours=1)
+        db.session.commit()
+        presence.record_seen(u)
+        self.assertGreater(u.last_seen, recent)
+        presence.load_last_seen(u)
+        self.assertEqual(presence.flush_last_seen(), 0)
+
+    def test_notification_publish(self):
+        self.app.redis = fakeredis.FakeRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        pubsub = self.app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(u.id))
+        u.add_notification('unread_message_count', 1)
+        self.assertEqual(db.session.info['notifications'], [
+            (u.id, {'name': 'unread_message_count', 'data': 1,
+                    'timestamp': mock.ANY})])
+        db.session.rollback()
+        self.assertNotIn('notifications', db.session.info)
+        self.assertIsNone(pubsub.get_message())
+        u.add_notification('unread_message_count', 2)
+        # published only once the session commits
+        self.assertIsNone(pubsub.get_message())
+        db.session.commit()
+        self.assertNotIn('notifications', db.session.info)
+        message = pubsub.get_message()
+        self.assertEqual(json.loads(message['data']),
+                         {'name': 'unread_message_count', 'data': 2,
+                          'timestamp': mock.ANY})
+        self.assertIsNone(pubsub.get_message())
+
+    def test_notification_publish_error(self):
+        self.app.redis = unavailable_redis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 2)
+        # publishing fails, but the commit does not
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            db.session.commit()
+        self.assertNotIn('notifications', db.session.info)
+        self.assertEqual(db.session.scalar(
+            u.notifications.select()).get_data(), 2)
+
+    def test_notification_upsert(self):
+        self.app.redis = fakeredis.FakeRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        def stored():
+            return [(n.name, n.get_data()) for n in db.session.scalars(
+                u.notifications.select().order_by(Notification.name))]
+
+        u.add_notification('post_liked', {'post_id': 1})
+        u.add_notification('post_liked', {'post_id': 2})
+        u.add_notification('unread_message_count', 3)
+        db.session.commit()
+        self.assertEqual(stored(), [('post_liked', {'post_id': 2}),
+                                    ('unread_message_count', 3)])
+        # within the interval, coalesced notifications are held back and
+        # the latest one is written by the flush scheduled for its end
+        u.add_notification('unread_message_count', 4)
+        u.add_notification('unread_message_count', 5)
+        db.session.commit()
+        self.assertEqual(stored()[1], ('unread_message_count', 3))
+        self.assertEqual(
+            len(self.app.task_queue.scheduled_job_registry.get_job_ids()), 1)
+        Notification.flush(u.id, 'unread_message_count')
+        self.assertEqual(stored()[1], ('unread_message_count', 5))
+        self.assertFalse(self.app.redis.exists('notification:pending'))
+        u.add_notification('unread_message_count', 6, force=True)
+        db.session.commit()
+        self.assertEqual(stored()[1], ('unread_message_count', 6))
+        # an older notification does not replace a newer one
+        Notification.store(u.id, 'post_liked', {'post_id': 1}, 0)
+        db.session.commit()
+        self.assertEqual(stored()[0], ('post_liked', {'post_id': 2}))
+
+    def test_notification_upsert_fallback(self):
+        # without Redis, coalesced notifications are written right away
+        self.app.redis = unavailable_redis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        for count in (3, 4):
+            u.add_notification('unread_message_count', count)
+            db.session.commit()
+            self.assertEqual(db.session.scalar(
+                u.notifications.select()).get_data(), count)
+        Notification.flush(u.id, 'unread_message_count')
+        self.assertEqual(db.session.scalar(
+            u.notifications.select()).get_data(), 4)
+
+    def test_export_posts(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([u] + [
+            Post(body=f'post {i}', author=u,
+                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as directory:
+            path = exports.export_path(directory, u)
+            self.assertEqual(exports.export_posts(u, path, batch_size=2), 5)
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                posts = [json.loads(line) for line in f]
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+        self.assertEqual([p['body'] for p in posts],
+                         [f'post {i}' for i in range(5)])
+
+    def test_export_progress(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.file_app(directory).app_context():
+                db.create_all()
+                u = User(username='john', email='john@example.com')
+                db.session.add_all([u] + [Post(body=f'post {i}', author=u)
+                                          for i in range(25)])
+                db.session.commit()
+                reports = []
+
+                def progress(percent):
+                    # progress is committed between batches, like tasks do
+                    reports.append(percent)
+                    u.about_me = f'{percent}%'
+                    db.session.commit()
+
+                path = exports.export_path(directory, u)
+                self.assertEqual(exports.export_posts(
+                    u, path, batch_size=10, progress=progress,
+                    progress_interval=0), 25)
+                self.assertEqual(reports, [40, 80])
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    self.assertEqual(len(f.readlines()), 25)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_translate_batch(self):
+        self.app.config['TRANSLATOR'] = 'stub'
+        translator = translate.get_translator()
+        with mock.patch.object(translator, 'translate',
+                               wraps=translator.translate) as upstream:
+            self.assertEqual(
+                translate.translate_batch(['hola', 'adiós', 'hola'], 'es',
+                                          'en'),
+                ['[en] hola', '[en] adiós', '[en] hola'])
+            self.assertEqual(upstream.call_count, 1)
+            self.assertEqual(upstream.call_args.args[0], ['hola', 'adiós'])
+            # served from the in-process cache
+            self.assertEqual(translate.translate('adiós', 'es', 'en'),
+                             '[en] adiós')
+            self.assertEqual(upstream.call_count, 1)
+            self.assertEqual(translate.translate('adiós', 'es', 'fr'),
+                             '[fr] adiós')
+            self.assertEqual(upstream.call_count, 2)
+
+    def test_translate_posts_request(self):
+        self.app.config['TRANSLATOR'] = 'stub'
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hola', author=u, language='es')
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.app.test_client_class = FlaskLoginClient
+        client = self.app.test_client(user=u)
+        for data in ({'post_ids': [p.id]}, {'post_ids': ['x'],
+                                            'dest_language': 'en'},
+                     {'post_ids': p.id, 'dest_language': 'en'}, [p.id]):
+            rv = client.post('/translate/posts', json=data)
+            self.assertEqual(rv.status_code, 400)
+        rv = client.post('/translate/posts', json={
+            'post_ids': [str(p.id)], 'dest_language': 'en'})
+        self.assertEqual(rv.get_json(),
+                         {'translations': {str(p.id): '[en] hola'}})
+
+    def test_backfill_languages(self):
+        self.app.elasticsearch = None
+        u = User(username='susan', email='susan@example.com')
+        db.session.add_all([
+            Post(body='The quick brown fox jumps over the lazy dog',
+                 author=u),
+            Post(body='El rápido zorro marrón salta sobre el perro perezoso',
+                 author=u),
+            Post(body='12345', author=u),
+            Post(body='Already detected', author=u, language='en')])
+        db.session.commit()
+        self.assertEqual(backfill_languages(2), (3, 2))
+        self.assertEqual(
+            db.session.scalars(sa.select(Post.language).order_by(Post.id))
+            .all(), ['en', 'es', '', 'en'])
+        self.assertEqual(backfill_languages(2), (0, 0))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)